@@ -4,14 +4,17 @@ import os
 import pickle
 import torch
 import glob
-import clip
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'global'))
+from criteria.clip_registry import get_clip
 from PIL import Image
 from torchvision.datasets.folder import ImageFolder
 from torch.nn import functional as F
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load('ViT-B/32', device)
+model, preprocess = get_clip('ViT-B/32', device)
 data_dir = "../dataset/imagenet/"
 with open("./semantics/imagenet.pkl", 'rb') as f:
     dt = pickle.load(f)
@@ -1,12 +1,16 @@
 import pickle
 import torch
 import clip
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'global'))
+from criteria.clip_registry import get_clip
 from pathlib import Path
 import json
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load('ViT-B/32', device)
+model, preprocess = get_clip('ViT-B/32', device)
 imagenet_path = Path("../dataset/imagenet/")
 
 with open(imagenet_path/"imagenet_class_index.json", 'r') as f:
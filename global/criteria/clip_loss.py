@@ -1,27 +1,78 @@
 import torch
 import clip
 
+from utils.text_cache import get_text_cache
+from criteria.clip_registry import get_clip
+
 class CLIPLoss(torch.nn.Module):
 
     def __init__(self, opts):
         super(CLIPLoss, self).__init__()
-        self.model, self.preprocess = clip.load("ViT-B/32", device="cuda:0")
+        self.model_name = "ViT-B/32"
+        self.model, self.preprocess = get_clip(self.model_name, device=getattr(opts, 'device', None))
         self.upsample = torch.nn.Upsample(scale_factor=7)
         self.avg_pool = torch.nn.AvgPool2d(kernel_size=opts.stylegan_size // 32)
+        self.resize_matrices = {}
+        # opt-in reduced precision for the image encoder
+        self.image_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(getattr(opts, 'precision', "fp32"))
+
+    def resize_matrix(self, size, device):
+        """
+        (224, size) area resampling matrix A: A @ x @ A^T averages the input over each output pixel's
+        footprint. For sizes that are multiples of 32 this equals the 7x nearest upsample followed by
+        a (size // 32) average pool, without materializing the 7x image; other sizes (e.g. small
+        max_res previews) come out at 224 as well
+        """
+        if (size, device) not in self.resize_matrices:
+            edges = torch.arange(225, dtype=torch.float64) * size / 224
+            pixels = torch.arange(size + 1, dtype=torch.float64)
+            overlap = torch.minimum(edges[1:, None], pixels[None, 1:]) - torch.maximum(edges[:-1, None], pixels[None, :-1])
+            A = overlap.clamp(min=0) / (size / 224)
+            self.resize_matrices[(size, device)] = A.float().to(device)
+        return self.resize_matrices[(size, device)]
+
+    def resize(self, image):
+        """
+        (B, 3, H, W) generated images -> (B, 3, 224, 224) CLIP input
+        """
+        A_h = self.resize_matrix(image.shape[-2], image.device).to(image.dtype)
+        A_w = self.resize_matrix(image.shape[-1], image.device).to(image.dtype)
+        return A_h @ image @ A_w.t()
+
+    def resize_difference(self, image):
+        """
+        Max abs difference of the CLIP input and cosine similarity of the image features
+        between resize and the upsample + average pool path it replaces
+        """
+        with torch.no_grad():
+            old = self.avg_pool(self.upsample(image))
+            new = self.resize(image)
+            f_old = self.model.encode_image(old).float()
+            f_new = self.model.encode_image(new).float()
+        return {'pixel': (old - new).abs().max().item(),
+                'feature': torch.nn.functional.cosine_similarity(f_old, f_new).min().item()}
 
     def forward(self, image, text):
-        image = self.avg_pool(self.upsample(image))
+        image = self.resize(image)
         similarity = 1 - self.model(image, text)[0] / 100
         return similarity
 
     def encode_text(self, text):
-        tokenized = torch.cat([clip.tokenize(text)]).cuda()
-        text_features = self.model.encode_text(tokenized.long())
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        return text_features.float()
+        """
+        Normalized text features, served from the text embedding cache
+        """
+        def encode(texts):
+            tokenized = torch.cat([clip.tokenize(texts)]).to(self.model.text_projection.device)
+            with torch.no_grad():
+                text_features = self.model.encode_text(tokenized.long())
+            return text_features / text_features.norm(dim=-1, keepdim=True)
+        texts = [text] if isinstance(text, str) else list(text)
+        text_features = get_text_cache().lookup(texts, self.model_name, ("{}", ), encode, dtype=self.model.text_projection.dtype)
+        return text_features.to(self.model.text_projection.device)
 
     def encode_image(self, image):
-        image = self.avg_pool(self.upsample(image))
-        image_features = self.model.encode_image(image)
+        image = self.resize(image)
+        with torch.autocast(image.device.type, dtype=self.image_dtype, enabled=self.image_dtype is not None):
+            image_features = self.model.encode_image(image)
         image_features = image_features/image_features.norm(dim=-1, keepdim=True)
         return image_features.float()
\ No newline at end of file
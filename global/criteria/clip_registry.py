@@ -0,0 +1,41 @@
+import torch
+import clip
+
+_MODELS = {}
+_DEFAULTS = {"device": None, "precision": None}
+_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def _device(device):
+    """
+    Canonical device, so that "cuda", "cuda:0" and torch.device("cuda:0") share one model
+    """
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device() if torch.cuda.is_available() else 0)
+    return device
+
+
+def configure(device=None, precision=None):
+    """
+    Default device and weight precision ("fp32" / "bf16" / "fp16", None keeps clip.load's choice) of get_clip
+    """
+    _DEFAULTS.update(device=device, precision=precision)
+
+
+def get_clip(name="ViT-B/32", device=None, precision=None):
+    """
+    Process-wide CLIP models, loaded on first use and shared by every caller
+    Returns:
+        model, preprocess
+    """
+    device = device if device is not None else _DEFAULTS["device"]
+    device = _device(device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    precision = precision if precision is not None else _DEFAULTS["precision"]
+    key = (name, device, precision)
+    if key not in _MODELS:
+        model, preprocess = clip.load(name, device=device)
+        if precision is not None:
+            model = model.to(_DTYPES[precision])
+        _MODELS[key] = (model.eval(), preprocess)
+    return _MODELS[key]
@@ -8,10 +8,14 @@ import numpy as np
 np.set_printoptions(suppress=True)
 
 from utils.utils import *
-from utils.global_dir_utils import create_dt, manipulate_image, create_image_S
+from utils.global_dir_utils import create_dt, manipulate_image
 # from utils.eval_utils import Text2Segment, maskImage
 from model import CrossModalAlign
+from criteria.clip_registry import configure
 from models.stylegan2.models import Generator
+from utils.result_cache import ResultCache, tensor_fingerprint
+from utils.style_stats import style_stats_files
+from utils.render_state import RenderStateCache
 from torchvision.utils import save_image
 
 def prepare(args):
@@ -33,6 +37,7 @@ def prepare(args):
     elif args.method=="Baseline":
         args.s_dict = s_dict
 
+    configure(device=args.device) # one shared CLIP model on this device
     align_model = CrossModalAlign(args)
     align_model.prototypes = torch.Tensor(args.s_dict).to(args.device)
     align_model.to(args.device)
@@ -45,13 +50,19 @@ def run_global(generator, align_model, args, targets, neutrals):
     subset_latents = torch.Tensor(test_latents[start_idx:start_idx+args.num_test]).cpu()
     img_dir = f"Composition-{args.method}-{args.dataset}"
     os.makedirs(img_dir, exist_ok=True)
+    # Baseline renders are deterministic and can be served from the result cache
+    result_cache = None
+    if args.cache_dir is not None and args.method=="Baseline":
+        result_cache = ResultCache(args.cache_dir, args.stylegan_weights, max_bytes=args.cache_size * 2**20, inputs=[args.s_dict_path, args.latents_path] + style_stats_files(args.dataset.lower(), args.nsml))
 
+    render_states = RenderStateCache(generator, align_model)
     for i, latent in enumerate(list(subset_latents)):
         latent = latent.unsqueeze(0).to(args.device)
         generated_images = []
         # original Image from latent code (W+)
-        img_orig, style_space, style_names, noise_constants = create_image_S(generator, latent)
-        align_model.image_feature = align_model.encode_image(img_orig)
+        state = render_states.get(start_idx+i, latent)
+        img_orig, style_space, style_names, noise_constants = state.img_orig, state.style_space, state.style_names, state.noise_constants
+        align_model.image_feature = state.image_feature
         generated_images.append(img_orig)
 
         id_loss = AverageMeter()
@@ -70,7 +81,13 @@ def run_global(generator, align_model, args, targets, neutrals):
             if idx >= 1:
                 t = t+prev_text
                 t = t/ np.linalg.norm(t)
-            img_gen, _, _ = manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=5, t=t, s_dict=args.s_dict, device=args.device)
+            render = lambda: manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=5, t=t, s_dict=args.s_dict, device=args.device)[0]
+            if result_cache is not None:
+                # the edit composes every target so far
+                fields = dict(latent=tensor_fingerprint(latent), target=targets[:idx+1], neutral=neutrals[:idx+1], method=args.method, alpha=5, topk=args.topk, beta=getattr(args, 'beta', None), dataset=args.dataset)
+                img_gen = result_cache.render(fields, render, device=args.device)
+            else:
+                img_gen = render()
             
             prev_text = t
             generated_images.append(img_gen)
@@ -104,6 +121,8 @@ if __name__=="__main__":
     parser.add_argument("--nsml", action="store_true", help="run on the nsml server")
     parser.add_argument("--dataset", type=str, default="FFHQ", choices=["FFHQ", "AFHQ"])
     parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the result cache for Baseline renders")
+    parser.add_argument("--cache_size", type=int, default=1024, help="Result cache size in MB")
 
     args = parser.parse_args()
     args.device = torch.device(f"cuda:{args.gpu}" if torch.cuda.is_available() else 'cpu')
@@ -8,16 +8,22 @@ import numpy as np
 np.set_printoptions(suppress=True)
 
 from utils.utils import *
-from utils.global_dir_utils import create_dt, manipulate_image, manipulate_image_dir, create_image_S
+from utils.global_dir_utils import create_dt, manipulate_image, manipulate_image_dir
+from utils.global_dir_utils import GetBoundaries, NormalizeBoundary, SplitS, MSCodeBatch, decode_batches, precision_check
+from utils.stylegan_models import encoder, PRECISIONS, CompiledDecoder, preview_generator
+from criteria.clip_registry import configure
+from utils.result_cache import ResultCache, tensor_fingerprint
+from utils.style_stats import style_stats_files
+from utils.render_state import RenderStateCache
+from utils.startup_profile import profile_startup
 # from utils.eval_utils import Text2Segment, maskImage
 from model import CrossModalAlign
 from models.stylegan2.models import Generator
-from torchvision.utils import make_grid
+from torchvision.utils import make_grid, save_image
 import torchvision.transforms.functional as F
-import matplotlib.pyplot as plt
 
 def show(imgs, column_names, save_name, dpi=1800, suptitle=None):
-    
+    import matplotlib.pyplot as plt
     fig, axs = plt.subplots(nrows=len(imgs), squeeze=False)
     for i, img in enumerate(imgs):
         img = img.detach()
@@ -54,6 +60,11 @@ def prepare(args):
     generator.load_state_dict(torch.load(args.stylegan_weights, map_location='cpu')['g_ema'])
     generator.eval()
     generator.to(args.device)
+    # reduced precision decoder activations (style space decoder only)
+    generator.decode_dtype = PRECISIONS[getattr(args, 'precision', "fp32")]
+    # every CLIP user (CLIPLoss, plots, ...) shares one model on this device; --precision only
+    # affects the image encoder, which CLIPLoss.encode_image autocasts
+    configure(device=args.device)
 
     # Load anchors
     s_dict = np.load(args.s_dict_path)
@@ -71,32 +82,53 @@ def run_global(generator, align_model, args):
     start_idx = 1
     latent = torch.Tensor(test_latents[start_idx][None]).to(args.device)
     
+    # Baseline renders are deterministic and can be served from the result cache
+    result_cache = None
+    if args.cache_dir is not None and args.method=="Baseline" and args.alphas is None:
+        result_cache = ResultCache(args.cache_dir, args.stylegan_weights, max_bytes=args.cache_size * 2**20, inputs=[args.s_dict_path, args.latents_path] + style_stats_files(args.dataset.lower(), args.nsml))
+        latent_key = tensor_fingerprint(latent)
+
     # import lpips
     # lpips_alex = lpips.LPIPS(net='alex')
     # lpips_alex = lpips_alex.to(args.device)
+    # original Image from latent code (W+), rendered and encoded once for all targets
+    render_states = RenderStateCache(generator, align_model, max_size=args.render_states, prefix_cache=True)
+    state = render_states.get(start_idx, latent)
+    style_space, style_names, noise_constants = state.style_space, state.style_names, state.noise_constants
+    img_orig, prefix_cache = state.img_orig, state.prefix_cache
+    align_model.image_feature = state.image_feature
+    if args.check_precision and generator.decode_dtype is not None:
+        print(f"{args.precision} vs fp32:", precision_check(generator, style_space, latent, noise_constants, generator.decode_dtype, align_model))
+
     grids = []
     for target in args.targets:
         generated_images = []
-        target_embedding = create_dt(target, model=align_model.model)
+        target_embedding = create_dt(target, model=align_model.model, neutral=args.neutral)
         align_model.text_feature = target_embedding
-        
-        # original Image from latent code (W+)
-        img_orig, style_space, style_names, noise_constants = create_image_S(generator, latent)
-        align_model.image_feature = align_model.encode_image(img_orig)
         generated_images.append(img_orig.detach().cpu().squeeze(0))
         
         # id_loss = AverageMeter()
-        for _ in range(args.num_attempts):
+        alpha = args.alpha if args.alphas is None else args.alphas
+        if args.method!="Baseline":
+            # all attempts drawn from one decomposition of the target
+            surgeries = align_model.cross_modal_surgeries(target_embedding, args.num_attempts, fixed_weight=False).cpu().numpy()
+        for attempt in range(args.num_attempts):
             # StyleCLIP GlobalDirection 
             if args.method=="Baseline":
                 t = target_embedding.detach().cpu().numpy()
                 t = t/np.linalg.norm(t)
-                img_gen, _, _ = manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=args.alpha, t=t, s_dict=args.s_dict, device=args.device)
+                render = lambda: manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=alpha, t=t, s_dict=args.s_dict, device=args.device, cache=prefix_cache)[0]
+                if result_cache is not None:
+                    fields = dict(latent=latent_key, target=target, neutral=args.neutral, method=args.method, alpha=alpha, topk=args.topk, beta=args.beta, dataset=args.dataset, precision=args.precision)
+                    img_gen = result_cache.render(fields, render, device=args.device)
+                else:
+                    img_gen = render()
             else:
                 # Random Interpolation
-                m_idxs, m_weights = align_model.cross_modal_surgery(fixed_weight=False)
-                img_gen, _, _ = manipulate_image_dir(style_space, style_names, noise_constants, generator, latent, args, alpha=args.alpha, m_idxs=m_idxs, m_weights=m_weights, s_dict=args.s_dict, device=args.device)
-            generated_images.append(img_gen.detach().cpu().squeeze(0))
+                m_idxs = [np.flatnonzero(surgeries[attempt])]
+                m_weights = [surgeries[attempt][m_idxs[0]]]
+                img_gen, _, _ = manipulate_image_dir(style_space, style_names, noise_constants, generator, latent, args, alpha=alpha, m_idxs=m_idxs, m_weights=m_weights, s_dict=args.s_dict, device=args.device, cache=prefix_cache)
+            generated_images.extend(img_gen.detach().cpu())
             
             # Evaluation
             # with torch.no_grad():
@@ -128,10 +160,61 @@ def run_global(generator, align_model, args):
         #         lpips_value = sum(values) / (1.0* len(values))
         #         lpips_value = lpips_value[0][0][0][0].cpu().item()
 
-        grid = make_grid(generated_images, nrow=args.num_attempts+1, normalize=True, value_range=(-1, 1))
+        grid = make_grid(generated_images, nrow=len(generated_images), normalize=True, value_range=(-1, 1))
         grids.append(grid)
     show(grids, column_names=args.targets, save_name=f'{args.dataset}.png', dpi=1800, suptitle=f"{args.method} latent: {start_idx} top: {args.topk} alpha: {args.alpha}")
 
+def run_global_batched(generator, align_model, args):
+    """
+    Render num_test latents from start_idx against every target, batch_size images per decoder call.
+    Writes one image per latent/target: original followed by the attempts
+    """
+    test_latents = torch.load(args.latents_path, map_location='cpu')
+    end_idx = len(test_latents) if args.num_test == -1 else args.start_idx + args.num_test
+    latents = torch.Tensor(test_latents[args.start_idx:end_idx]).to(args.device)
+    img_dir = os.path.join("results", args.dataset, args.method)
+    os.makedirs(img_dir, exist_ok=True)
+
+    # Style codes of every latent up front
+    with torch.no_grad():
+        style_space, style_names, noise_constants = encoder(generator, latents)
+
+    # Boundaries do not depend on the latent: one per target (and attempt)
+    num_attempts = 1 if args.method=="Baseline" else args.num_attempts
+    ds = [np.zeros((1, args.s_dict.shape[0]), dtype=args.s_dict.dtype)] # original image
+    target_embeddings = torch.cat([create_dt(target, model=align_model.model, neutral=args.neutral) for target in args.targets])
+    if args.method=="Baseline":
+        t = target_embeddings.detach().cpu().numpy()
+        t = t/np.linalg.norm(t, axis=-1, keepdims=True)
+        ds_imp, _, _ = GetBoundaries(args.s_dict, t, args)
+    else:
+        # every target and attempt in one batched surgery
+        weights = align_model.cross_modal_surgeries(target_embeddings, num_attempts, fixed_weight=False)
+        ds_imp = NormalizeBoundary(weights.cpu().numpy()).astype(args.s_dict.dtype)
+    ds.append(ds_imp)
+    boundary, _ = SplitS(np.concatenate(ds), style_names, style_space, args.nsml, args.dataset)
+    codes = MSCodeBatch(style_space, boundary, args.alpha)
+    num_codes = codes[0].shape[0] // len(latents)
+    code_latents = latents.repeat_interleave(num_codes, dim=0)
+
+    # --preview_res: decode with a generator built and loaded only up to that resolution
+    decode_generator = generator
+    if args.preview_res is not None:
+        decode_generator = preview_generator(generator.state_dict(), args.preview_res).eval().to(args.device)
+        decode_generator.decode_dtype = generator.decode_dtype
+    decode = CompiledDecoder(decode_generator) if args.compile else None
+    pending, latent_idx = [], 0
+    for _, img_gen in decode_batches(decode_generator, codes, code_latents, noise_constants, args.batch_size, decode=decode, max_res=args.preview_res):
+        pending.extend(img_gen.detach().cpu())
+        # write every latent whose images are complete
+        while len(pending) >= num_codes:
+            imgs, pending = pending[:num_codes], pending[num_codes:]
+            for i, target in enumerate(args.targets):
+                row = [imgs[0]] + imgs[1 + i*num_attempts:1 + (i+1)*num_attempts]
+                img_name = f"img-{args.method}-{args.start_idx + latent_idx}-{target}"
+                save_image(row, f"{img_dir}/{img_name}.png", nrow=len(row), normalize=True, value_range=(-1, 1))
+            latent_idx += 1
+
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='Configuration for styleCLIP Global Direction with our method')
@@ -139,6 +222,7 @@ if __name__=="__main__":
     parser.add_argument('--num_attempts', type=int, default=3, help="Number of iterations for diversity measurement")
     parser.add_argument('--topk', type=int, default=50, help="Number of channels to modify")
     parser.add_argument('--alpha', type=int, default=5, help="Manpulation strength")
+    parser.add_argument('--alphas', type=float, nargs='+', default=None, help="Sweep of manipulation strengths rendered in one batch")
     parser.add_argument('--num_test', type=int, default=1, help="Number of latents to test for debugging, if -1 then use all 100 images")
     parser.add_argument('--trg_lambda', type=float, default=0.5, help="weight for preserving the information of target")
     parser.add_argument('--temperature', type=float, default=1.0, help="Used for bernoulli")
@@ -149,8 +233,22 @@ if __name__=="__main__":
     parser.add_argument("--nsml", action="store_true", help="run on the nsml server")
     parser.add_argument("--dataset", type=str, default="ffhq", choices=["ffhq", "afhqcat", "afhqdog", "church", 'car'])
     parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--batched", action="store_true", help="render num_test latents x targets in batches")
+    parser.add_argument("--start_idx", type=int, default=1, help="First test latent used by --batched")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of images per decoder call in --batched")
+    parser.add_argument("--preview_res", type=int, default=None, help="Stop the decoder at this resolution in --batched (e.g. 256 for triage)")
+    parser.add_argument("--profile-startup", action="store_true", help="Print the import time of this script per module and exit")
+    parser.add_argument("--compile", action="store_true", help="Compile the decoder (torch.compile or TorchScript) in --batched")
+    parser.add_argument("--precision", type=str, default="fp32", choices=list(PRECISIONS), help="Activation precision of the decoder and CLIP image encoder")
+    parser.add_argument("--check_precision", action="store_true", help="Report PSNR and CLIP similarity of the reduced precision render against fp32")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Directory of the result cache for Baseline renders")
+    parser.add_argument("--cache_size", type=int, default=1024, help="Result cache size in MB")
+    parser.add_argument("--render_states", type=int, default=4, help="Number of latents whose original render and CLIP feature are kept in memory")
 
     args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup("global", cwd=os.path.dirname(os.path.abspath(__file__)))
+        sys.exit()
     args.device = torch.device(f"cuda:{args.gpu}" if torch.cuda.is_available() else 'cpu')
     args.stylegan_weights = f'../Pretrained/stylegan2/{args.dataset}.pt'
     args.s_dict_path = f'./dictionary/{args.dataset}/fs3.npy'
@@ -167,4 +265,7 @@ if __name__=="__main__":
     args.targets = ["man", 'man with long hair', 'Young', 'Old', 'Glasses', 'Smiling']
     
     args.neutral = ""
-    run_global(generator, align_model, args)
+    if args.batched:
+        run_global_batched(generator, align_model, args)
+    else:
+        run_global(generator, align_model, args)
@@ -12,20 +12,17 @@ sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
 import torch
 from torch import arccos, nn
 import torch.distributions as D
-from numpy import linspace
 from criteria.clip_loss import CLIPLoss
 from criteria.id_loss import IDLoss
 from utils.utils import l2norm
-from sklearn.neighbors import LocalOutlierFactor
-from sklearn.neighbors.kde import KernelDensity
-from scipy.signal import find_peaks
-from matplotlib import pyplot as plt
-import pandas as pd
-import seaborn as sns
-from matplotlib import gridspec
-from scipy import stats
+from utils.global_dir_utils import GetBoundaries_dir, SparseS
+from utils.density import lof_1d, binned_kde, last_two_peaks
+# sklearn, scipy, pandas and matplotlib are imported where they are used to keep startup fast
 
 def kde_bivariate_plot(df):
+    from matplotlib import pyplot as plt
+    from matplotlib import gridspec
+    from scipy import stats
     cl = ['b','y','r', 'g', 'm', 'k'] # Custom list of colours for each categories - increase as needed...
 
     headers = list(df.columns) # Extract list of column headers
@@ -95,10 +92,6 @@ def kde_bivariate_plot(df):
     plt.savefig('plot.png', dpi=1800)
     plt.clf()
 
-def bool2idx(b_list):
-    tmp = [idx for idx, state in enumerate(b_list) if state]
-    return tmp
-
 def slerp(p0, p1, t):
     """
     p0, p1 : vector
@@ -120,18 +113,14 @@ class CrossModalAlign(CLIPLoss):
         """
         # Target Text Dissection
         text_probs = (self.text_feature @ self.prototypes.T)
-        df = self.break_down(text_probs)
-        core_mask = np.array(df['categories']=='core')
-        peri_mask = np.array(df['categories']=='peripheral')
-        
-        # core_mask, peri_mask = self.break_down(text_probs) # return in numpy arrays (6048, )
+        core_mask, peri_mask, _ = self.break_down(text_probs) # return in numpy arrays (1, 6048)
 
         # VERSION 1 : DIRECTLY MANIPULATE THE CHANNELS
         # Initialize the result array 
         m_idxs, m_weights = [], []
 
         # boolean array to index (which is True)
-        core_mask, peri_mask = bool2idx(core_mask), bool2idx(peri_mask)
+        core_mask, peri_mask = np.flatnonzero(core_mask), np.flatnonzero(peri_mask)
 
         core_semantics = self.prototypes[core_mask]
         weights =  self.text_feature @ core_semantics.T
@@ -156,7 +145,7 @@ class CrossModalAlign(CLIPLoss):
         
         # image_probs = (self.image_feature @ self.prototypes.T)
         # c, p = self.break_down(image_probs) 
-        # c, p = bool2idx(c), bool2idx(p)
+        # c, p = np.flatnonzero(c), np.flatnonzero(p)
 
         # img_mask = np.union1d(c, p)
         # txt_mask = np.union1d(core_mask, peri_mask)
@@ -170,6 +159,39 @@ class CrossModalAlign(CLIPLoss):
         # m_weights.extend(img_weights.detach().cpu().numpy())
 
         return m_idxs, m_weights
+
+    def cross_modal_surgeries(self, text_features, num_samples=1, fixed_weight=False):
+        """
+        Batched cross_modal_surgery: the decomposition is computed once per target and
+        num_samples draws per target are taken in one go
+        text_features: (N, 512) target embeddings
+        Returns:
+            dense channel weights (N * num_samples, 6048), the draws of each target consecutive;
+            NormalizeBoundary of these rows equals GetBoundaries_dir of the per-call surgeries
+        """
+        text_probs = text_features @ self.prototypes.T # (N, 6048)
+        core_mask, peri_mask, _ = self.break_down(text_probs)
+        weights = text_probs.detach().repeat_interleave(num_samples, dim=0)
+        core_mask = torch.from_numpy(core_mask).to(weights.device).repeat_interleave(num_samples, dim=0)
+        peri_mask = torch.from_numpy(peri_mask).to(weights.device).repeat_interleave(num_samples, dim=0)
+        if not fixed_weight:
+            # CORE: relaxed bernoulli edges keeping the sign, PERIPHERAL: bernoulli gated weights
+            core_probs = torch.where(core_mask, torch.abs(weights), torch.full_like(weights, 0.5))
+            random_edges = D.relaxed_bernoulli.RelaxedBernoulli(probs=core_probs, temperature=torch.ones_like(weights))
+            core_weights = random_edges.sample() * torch.sign(weights)
+            peri_weights = weights * D.bernoulli.Bernoulli(logits=torch.abs(weights)).sample()
+        else:
+            core_weights, peri_weights = weights, weights
+        return torch.where(core_mask, core_weights, torch.where(peri_mask, peri_weights, torch.zeros_like(weights)))
+
+    def cross_modal_edit(self, style_space, style_names, fixed_weight=False):
+        """
+            cross_modal_surgery routed to the style space as a SparseEdit of (layer, channel, delta) triples
+        """
+        m_idxs, m_weights = self.cross_modal_surgery(fixed_weight=fixed_weight)
+        ds_imp, _ = GetBoundaries_dir(self.args.s_dict, [m_idxs], [m_weights])
+        edit, _ = SparseS(ds_imp[0], style_names, style_space, self.args.nsml, getattr(self.args, 'dataset', 'ffhq').lower())
+        return edit
      
     
     def projection(self, basis, target):
@@ -180,41 +202,34 @@ class CrossModalAlign(CLIPLoss):
         return l2norm((X.dot(B.T)/B.dot(B) * B).unsqueeze(0)).cuda()
 
     def break_down(self, probs, plot=False):
-        clf = LocalOutlierFactor(algorithm='auto')
-        probs = probs.T.cpu().detach().numpy()
-        _ = clf.fit_predict(np.abs(probs))
-        lof_score = -clf.negative_outlier_factor_
-        kde = stats.gaussian_kde(np.abs(probs).flatten(), weights=lof_score)
-        # kde = stats.gaussian_kde(np.vstack([lof_score.flatten(), probs.flatten()]),  bw_method='silverman')
-        s1 = linspace(np.min(np.abs(probs)), np.max(np.abs(probs)), 100)
-        # s2 = linspace(np.min(probs), np.max(probs), 100)
-        kernel = kde(s1)
-        # kde = KernelDensity(kernel='linear', bandwidth=0.01).fit(lof_score.reshape(-1, 1))
-        
-        # e = kde.score_samples(s.reshape(-1, 1)) # reshape a single feature
-        mi = find_peaks(kernel)[0]
-        print(mi)
-        a, b = mi[-2], mi[-1]
-        lof_score = lof_score.flatten()
-        categories = ['unwanted' if c1 else 'peripheral' if c2 else 'core' for c1, c2 in zip(np.abs(probs) < s1[a],(np.abs(probs)>=s1[a])*(np.abs(probs)<s1[b]))]
-        
-        # core_mask, peri_mask = .squeeze(0), np.array().squeeze(0)
-        df = pd.DataFrame(
-            {
-            'probs': np.abs(probs).flatten(), 
-            'lof': np.log(lof_score).flatten(),
-            'categories': categories,
-            }
-            )
+        """
+        Split the channels into core / peripheral / unwanted by the LOF weighted density of |probs|,
+        for each of the N targets in probs (N, 6048) at once
+        Returns:
+            core_mask, peri_mask: boolean arrays (N, 6048)
+            lof_score: (N, 6048)
+        """
+        probs = np.abs(probs.cpu().detach().numpy()).reshape(-1, probs.shape[-1]).T # (6048, N)
+        lof_score = lof_1d(probs, k=20)
+        s1, kernel = binned_kde(probs, weights=lof_score, gridsize=100)
+        a, b = last_two_peaks(kernel)
+        cols = np.arange(probs.shape[1])
+        core_mask = probs >= s1[b, cols]
+        peri_mask = (probs >= s1[a, cols]) & (probs < s1[b, cols])
+
         if plot:
+            import pandas as pd
+            categories = np.where(core_mask, 'core', np.where(peri_mask, 'peripheral', 'unwanted'))
+            df = pd.DataFrame(
+                {
+                'probs': probs[:, 0], 
+                'lof': np.log(lof_score[:, 0]),
+                'categories': categories[:, 0],
+                }
+                )
             kde_bivariate_plot(df)
             exit()
-        else:
-            pass
-        return df
-        
-        
-
+        return core_mask.T, peri_mask.T, lof_score.T
 
     # def evaluation(self, img_orig, img_gen, target):
     #     """
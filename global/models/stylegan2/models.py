@@ -6,7 +6,7 @@ from torch import nn
 from torch.nn import functional as F
 import torch.nn.init as init
 
-from .op import FusedLeakyReLU, fused_leaky_relu, upfirdn2d
+from .op import FusedLeakyReLU, fused_leaky_relu, upfirdn2d, separable_factors
 
 
 class PixelNorm(nn.Module):
@@ -28,13 +28,29 @@ def make_kernel(k):
     return k
 
 
-class Upsample(nn.Module):
+class _FIRFilter(nn.Module):
+    """
+    Holds a FIR kernel buffer with its separable factors, computed once here so that
+    upfirdn2d never reads the kernel back to the host in forward
+    """
+    def register_kernel(self, kernel):
+        self.register_buffer("kernel", kernel)
+        factors = separable_factors(kernel)
+        self.register_buffer("kernel_col", factors[0] if factors else None, persistent=False)
+        self.register_buffer("kernel_row", factors[1] if factors else None, persistent=False)
+
+    @property
+    def factors(self):
+        return () if self.kernel_col is None else (self.kernel_col, self.kernel_row)
+
+
+class Upsample(_FIRFilter):
     def __init__(self, kernel, factor=2):
         super().__init__()
 
         self.factor = factor
         kernel = make_kernel(kernel) * (factor ** 2)
-        self.register_buffer("kernel", kernel)
+        self.register_kernel(kernel)
 
         p = kernel.shape[0] - factor
 
@@ -44,18 +60,18 @@ class Upsample(nn.Module):
         self.pad = (pad0, pad1)
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, up=self.factor, down=1, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, up=self.factor, down=1, pad=self.pad, factors=self.factors)
 
         return out
 
 
-class Downsample(nn.Module):
+class Downsample(_FIRFilter):
     def __init__(self, kernel, factor=2):
         super().__init__()
 
         self.factor = factor
         kernel = make_kernel(kernel)
-        self.register_buffer("kernel", kernel)
+        self.register_kernel(kernel)
 
         p = kernel.shape[0] - factor
 
@@ -65,12 +81,12 @@ class Downsample(nn.Module):
         self.pad = (pad0, pad1)
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, up=1, down=self.factor, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, up=1, down=self.factor, pad=self.pad, factors=self.factors)
 
         return out
 
 
-class Blur(nn.Module):
+class Blur(_FIRFilter):
     def __init__(self, kernel, pad, upsample_factor=1):
         super().__init__()
 
@@ -79,12 +95,12 @@ class Blur(nn.Module):
         if upsample_factor > 1:
             kernel = kernel * (upsample_factor ** 2)
 
-        self.register_buffer("kernel", kernel)
+        self.register_kernel(kernel)
 
         self.pad = pad
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, pad=self.pad, factors=self.factors)
 
         return out
 
@@ -187,6 +203,7 @@ class ModulatedConv2d(nn.Module):
         upsample=False,
         downsample=False,
         blur_kernel=[1, 3, 3, 1],
+        fused=None,
     ):
         super().__init__()
 
@@ -224,6 +241,11 @@ class ModulatedConv2d(nn.Module):
         self.modulation = EqualLinear(style_dim, in_channel, bias_init=1)
 
         self.demodulate = demodulate
+        # True: per-sample weights and a grouped conv, False: modulate the input and share the weight,
+        # None: pick by batch size
+        self.fused = fused
+        self._table = None
+        self._table_key = None
 
     def __repr__(self):
         return (
@@ -231,22 +253,76 @@ class ModulatedConv2d(nn.Module):
             f"upsample={self.upsample}, downsample={self.downsample})"
         )
 
+    # batches at least this large use the shared-weight path when fused is None
+    fused_batch_threshold = 2
+
     def forward(self, input, style):
+        return self.modulated(input, self.modulation(style))
+
+    def weight_table(self):
+        """
+        Sum of the squared (scaled) kernel over the spatial taps, (out_channel, in_channel).
+        Kept until the weight is modified (e.g. load_state_dict, optimizer step, .to());
+        computed inline under torch.compile, which cannot trace the data pointer check
+        """
+        if (torch.is_grad_enabled() and self.weight.requires_grad) or torch.compiler.is_compiling():
+            return self.scale ** 2 * self.weight[0].pow(2).sum([2, 3])
+        key = (self.weight._version, self.weight.data_ptr(), self.weight.device)
+        if self._table_key != key:
+            self._table = self.scale ** 2 * self.weight.detach()[0].pow(2).sum([2, 3])
+            self._table_key = key
+        return self._table
+
+    def demodulation(self, style):
+        """
+        style: style space code (batch, in_channel) -> demodulation coefficients (batch, out_channel)
+        """
+        return torch.rsqrt(style.pow(2) @ self.weight_table().t() + 1e-8)
+
+    def modulated(self, input, style):
+        """
+        Modulated convolution with a style space code (batch, in_channel) instead of w.
+        The style, weight and demodulation stay in float32; the convolution itself runs
+        in the dtype of input
+        """
         batch, in_channel, height, width = input.shape
+        style = style.float().reshape(batch, in_channel)
+        fused = self.fused if self.fused is not None else batch < self.fused_batch_threshold
+        if fused:
+            return self._fused(input, style)
+
+        weight = (self.scale * self.weight[0]).to(input.dtype)
+        input = input * style.to(input.dtype).view(batch, in_channel, 1, 1)
+
+        if self.upsample:
+            out = F.conv_transpose2d(input, weight.transpose(0, 1), padding=0, stride=2)
+            out = self.blur(out)
+
+        elif self.downsample:
+            input = self.blur(input)
+            out = F.conv2d(input, weight, padding=0, stride=2)
+
+        else:
+            out = F.conv2d(input, weight, padding=self.padding)
 
-        style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
-        weight = self.scale * self.weight * style
+        if self.demodulate:
+            out = out * self.demodulation(style).to(out.dtype).view(batch, self.out_channel, 1, 1)
+
+        return out
+
+    def _fused(self, input, style):
+        batch, in_channel, height, width = input.shape
+        weight = self.scale * self.weight * style.view(batch, 1, in_channel, 1, 1)
 
         if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
-            weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
+            weight = weight * self.demodulation(style).view(batch, self.out_channel, 1, 1, 1)
 
-        weight = weight.view(
+        weight = weight.to(input.dtype).view(
             batch * self.out_channel, in_channel, self.kernel_size, self.kernel_size
         )
 
         if self.upsample:
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             weight = weight.view(
                 batch, self.out_channel, in_channel, self.kernel_size, self.kernel_size
             )
@@ -261,13 +337,13 @@ class ModulatedConv2d(nn.Module):
         elif self.downsample:
             input = self.blur(input)
             _, _, height, width = input.shape
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             out = F.conv2d(input, weight, padding=0, stride=2, groups=batch)
             _, _, height, width = out.shape
             out = out.view(batch, self.out_channel, height, width)
 
         else:
-            input = input.view(1, batch * in_channel, height, width)
+            input = input.reshape(1, batch * in_channel, height, width)
             out = F.conv2d(input, weight, padding=self.padding, groups=batch)
             _, _, height, width = out.shape
             out = out.view(batch, self.out_channel, height, width)
@@ -498,7 +574,11 @@ class Generator(nn.Module):
         input_is_latent=False,
         noise=None,
         randomize_noise=True,
+        max_res=None,
     ):
+        """
+        max_res: preview, stop after this resolution and return the RGB accumulated so far
+        """
         if not input_is_latent:
             styles = [self.style(s) for s in styles]
 
@@ -552,6 +632,8 @@ class Generator(nn.Module):
         for conv1, conv2, noise1, noise2, to_rgb in zip(
             self.convs[::2], self.convs[1::2], noise[1::2], noise[2::2], self.to_rgbs
         ):
+            if max_res is not None and out.shape[-1] * 2 > max_res:
+                break
             out = conv1(out, latent[:, i], noise=noise1)
             features["conv1_{}".format(i)] = out
             out = conv2(out, latent[:, i + 1], noise=noise2)
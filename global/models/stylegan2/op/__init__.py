@@ -1,2 +1,18 @@
-from .fused_act import FusedLeakyReLU, fused_leaky_relu
-from .upfirdn2d import upfirdn2d
+from . import fused_act as _native_act
+from . import upfirdn2d as _native_fir
+from . import separable as _separable
+from .separable import separable_factors
+from .backend import BACKENDS, register_backend, set_backend, get_backend
+from .fused_act import FusedLeakyReLU
+
+# native: the reference implementation, separable: separable/polyphase filtering on any device
+register_backend("separable", _separable.upfirdn2d, _separable.fused_leaky_relu)
+register_backend("native", _native_fir.upfirdn2d, _native_act.fused_leaky_relu)
+
+
+def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), factors=None):
+    return get_backend()["upfirdn2d"](input, kernel, up=up, down=down, pad=pad, factors=factors)
+
+
+def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
+    return get_backend()["fused_leaky_relu"](input, bias, negative_slope, scale)
@@ -0,0 +1,21 @@
+BACKENDS = {}
+_ACTIVE = {"name": None}
+
+
+def register_backend(name, upfirdn2d, fused_leaky_relu):
+    """
+    upfirdn2d(input, kernel, up, down, pad, factors), fused_leaky_relu(input, bias, negative_slope, scale)
+    """
+    BACKENDS[name] = {"upfirdn2d": upfirdn2d, "fused_leaky_relu": fused_leaky_relu}
+    if _ACTIVE["name"] is None:
+        _ACTIVE["name"] = name
+
+
+def set_backend(name):
+    if name not in BACKENDS:
+        raise ValueError(f"unknown op backend {name}, choose from {list(BACKENDS)}")
+    _ACTIVE["name"] = name
+
+
+def get_backend():
+    return BACKENDS[_ACTIVE["name"]]
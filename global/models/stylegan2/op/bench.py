@@ -0,0 +1,62 @@
+"""
+Microbenchmark of the op backends against the native reference.
+python -m models.stylegan2.op.bench --device cpu --batch 4
+"""
+import time
+import argparse
+
+import torch
+
+from . import BACKENDS, separable_factors
+from ..models import make_kernel
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark upfirdn2d and fused_leaky_relu backends")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256])
+    args = parser.parse_args()
+
+    kernel = make_kernel([1, 3, 3, 1]).to(args.device)
+    # (name, up, down, pad, kernel scale) as used by Upsample, Downsample and the Blur of ModulatedConv2d
+    cases = [
+        ("upsample", 2, 1, (2, 1), 4),
+        ("downsample", 1, 2, (1, 1), 1),
+        ("blur", 1, 1, (1, 1), 1),
+        ("blur-up", 1, 1, (1, 1), 4),
+    ]
+    with torch.no_grad():
+        for size in args.sizes:
+            channel = min(512, 2 ** 14 // size)
+            x = torch.randn(args.batch, channel, size, size, device=args.device)
+            for name, up, down, pad, scale in cases:
+                k = kernel * scale
+                factors = separable_factors(k) # as registered by Blur / Upsample / Downsample
+                ref = BACKENDS["native"]["upfirdn2d"](x, k, up=up, down=down, pad=pad)
+                row = f"{name:>10} {size:>4}x{size:<4} c={channel:<4}"
+                for backend, ops in BACKENDS.items():
+                    ms = timeit(lambda: ops["upfirdn2d"](x, k, up=up, down=down, pad=pad, factors=factors), args.repeat)
+                    err = (ops["upfirdn2d"](x, k, up=up, down=down, pad=pad, factors=factors) - ref).abs().max().item()
+                    row += f" | {backend}: {ms:8.2f} ms (err {err:.1e})"
+                print(row)
+
+            bias = torch.randn(channel, device=args.device)
+            ref = BACKENDS["native"]["fused_leaky_relu"](x, bias)
+            row = f"{'lrelu':>10} {size:>4}x{size:<4} c={channel:<4}"
+            for backend, ops in BACKENDS.items():
+                ms = timeit(lambda: ops["fused_leaky_relu"](x, bias), args.repeat)
+                err = (ops["fused_leaky_relu"](x, bias) - ref).abs().max().item()
+                row += f" | {backend}: {ms:8.2f} ms (err {err:.1e})"
+            print(row)
@@ -4,6 +4,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from .backend import get_backend
+
 module_path = os.path.dirname(__file__)
 
 
@@ -17,12 +19,12 @@ class FusedLeakyReLU(nn.Module):
         self.scale = scale
 
     def forward(self, input):
-        return fused_leaky_relu(input, self.bias, self.negative_slope, self.scale)
+        return get_backend()["fused_leaky_relu"](input, self.bias, self.negative_slope, self.scale)
 
 
 def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
     rest_dim = [1] * (input.ndim - bias.ndim - 1)
-    input = input.cuda()
+    bias = bias.to(input.dtype)
     if input.ndim == 3:
         return (
             F.leaky_relu(
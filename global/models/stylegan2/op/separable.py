@@ -0,0 +1,69 @@
+import torch
+from torch.nn import functional as F
+
+
+def separable_factors(kernel):
+    """
+    (kernel_h, 1) and (1, kernel_w) factors of a rank-1 kernel, or () if it is not separable.
+    Reads the kernel values on the host: compute once when the kernel is registered, not per call
+    """
+    kernel = kernel.detach().float()
+    col, row = kernel.sum(1, keepdim=True), kernel.sum(0, keepdim=True)
+    total = kernel.sum()
+    if total != 0 and torch.allclose(col @ row / total, kernel, atol=1e-6):
+        return (col / total, row)
+    return ()
+
+
+def _fir(input, kernel, up, down, pad):
+    """
+    Depthwise upfirdn of every channel with a (kernel_h, kernel_w) kernel.
+    up, down: (y, x) factors, pad: (x0, x1, y0, y1), negative pads crop
+    """
+    _, channel, in_h, in_w = input.shape
+    kernel_h, kernel_w = kernel.shape
+    pad_x0, pad_x1, pad_y0, pad_y1 = pad
+    out_h = (in_h * up[0] + pad_y0 + pad_y1 - kernel_h) // down[0] + 1
+    out_w = (in_w * up[1] + pad_x0 + pad_x1 - kernel_w) // down[1] + 1
+    weight = kernel.view(1, 1, kernel_h, kernel_w).expand(channel, 1, kernel_h, kernel_w)
+
+    if up == (1, 1):
+        out = F.pad(input, [pad_x0, pad_x1, pad_y0, pad_y1])
+        return F.conv2d(out, weight.flip([2, 3]), stride=down, groups=channel)
+
+    # polyphase: the strided transposed conv never multiplies the inserted zeros
+    out = F.conv_transpose2d(input, weight, stride=up, groups=channel)
+    start_y, start_x = kernel_h - 1 - pad_y0, kernel_w - 1 - pad_x0
+    end_y, end_x = start_y + (out_h - 1) * down[0] + 1, start_x + (out_w - 1) * down[1] + 1
+    out = F.pad(out, [-start_x, end_x - out.shape[3], -start_y, end_y - out.shape[2]])
+    return out[:, :, :: down[0], :: down[1]]
+
+
+def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), factors=None):
+    """
+    Same result as upfirdn2d_native on any device. Rank-1 kernels (e.g. the [1, 3, 3, 1] blur)
+    are applied as a vertical and a horizontal 1-D pass
+    factors: separable_factors(kernel) computed by the caller, None computes them here
+    """
+    if factors is None:
+        factors = separable_factors(kernel)
+    if not factors:
+        return _fir(input, kernel.to(input.dtype), (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1]))
+    col, row = [f.to(input.dtype) for f in factors]
+    out = _fir(input, col, (up, 1), (down, 1), (0, 0, pad[0], pad[1]))
+    return _fir(out, row, (1, up), (1, down), (pad[0], pad[1], 0, 0))
+
+
+def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
+    """
+    Bias, leaky relu and scale with one temporary, updated in place when no gradient is needed
+    """
+    rest_dim = [1] * (input.ndim - bias.ndim - 1)
+    bias = bias.to(input.dtype)
+    if input.ndim == 3:
+        out = input + bias.view(1, *rest_dim, bias.shape[0])
+    else:
+        out = input + bias.view(1, bias.shape[0], *rest_dim)
+    if torch.is_grad_enabled() and out.requires_grad:
+        return F.leaky_relu(out, negative_slope) * scale
+    return F.leaky_relu_(out, negative_slope).mul_(scale)
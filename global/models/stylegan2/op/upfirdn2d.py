@@ -8,9 +8,10 @@ module_path = os.path.dirname(__file__)
 
 
 
-def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
+def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), factors=None):
+    # factors (separable backend only) are not used by the reference implementation
     out = upfirdn2d_native(
-        input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1]
+        input, kernel.to(input.dtype), up, up, down, down, pad[0], pad[1], pad[0], pad[1]
     )
 
     return out
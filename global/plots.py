@@ -10,10 +10,10 @@ from utils.utils import project_away_pc
 import os
 import numpy as np
 import torch
-import clip
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 from utils.global_dir_utils import create_dt
+from criteria.clip_registry import get_clip
 device =torch.device("cuda:0" if torch.cuda.is_available() else 'cpu')
 
 
@@ -38,7 +38,7 @@ def plot_s_dict_box_plot(s_dict, texts):
     s_dict_center = s_dict - s_dict.mean(0, keepdims=True)
     x = np.vstack([s_dict, s_dict_center, s_dict_istr])
 
-    model, preprocess = clip.load('ViT-B/32', device=device)
+    model, preprocess = get_clip('ViT-B/32', device=device)
     dts=[]
     t = 4
     for i, text in enumerate(texts[:t]):
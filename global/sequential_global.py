@@ -14,15 +14,15 @@ from models.stylegan2.models import Generator
 
 from utils import *
 from utils.utils import *
-from utils.stylegan_models import encoder, decoder
-from utils.global_dir_utils import GetTemplate, GetBoundary, MSCode
+from utils.stylegan_models import decoder
+from utils.render_state import RenderStateCache
+from utils.global_dir_utils import GetTemplate, GetBoundary, MSCodeTorch
 
 from functools import partial
 
 def generate_image(s_dict, t, args, style_space, style_names, alpha=5):
     boundary_tmp2, _, _, _ = GetBoundary(s_dict, t.squeeze(axis=0), args, style_space, style_names) # Move each channel by dStyle
-    dlatents_loaded = [s.cpu().detach().numpy() for s in style_space]
-    manip_codes= MSCode(dlatents_loaded, boundary_tmp2, [alpha], device)
+    manip_codes= MSCodeTorch(style_space, [boundary_tmp2], [alpha])
     img_gen = decoder(generator, manip_codes, latent, noise_constants)
     return img_gen, manip_codes
 
@@ -75,7 +75,8 @@ if __name__=="__main__":
     generator.to(device)
  
     test_latents = torch.load(args.latents_path, map_location='cpu')
-    subset_latents = torch.Tensor(test_latents[args.num_test:args.num_test+1, :, :]).cpu()
+    latent_idx = args.num_test # index of the test latent to edit
+    subset_latents = torch.Tensor(test_latents[latent_idx:latent_idx+1, :, :]).cpu()
 
     
     s_dict = np.load(args.s_dict_path)
@@ -89,11 +90,10 @@ if __name__=="__main__":
     
     latent = subset_latents[0].unsqueeze(0).to(device)
     imgs=[]
-    with torch.no_grad():
-        style_space, style_names, noise_constants = encoder(generator, latent)
-        img_orig = decoder(generator, style_space, latent, noise_constants)
-        align_model.image_feature = align_model.encode_image(img_orig)
-        imgs.append(img_orig)
+    state = RenderStateCache(generator, align_model).get(latent_idx, latent)
+    style_space, style_names, noise_constants = state.style_space, state.style_names, state.noise_constants
+    align_model.image_feature = state.image_feature
+    imgs.append(state.img_orig)
     seq_imgs = sequential_gen(s_dict, descriptions, args, style_space, style_names, align_model.model)
     imgs.extend(seq_imgs)
     align_model.text_feature = create_dt(' '.join(descriptions[-1]), align_model.model).to(device)
@@ -0,0 +1,226 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import json
+import queue
+import socket
+import argparse
+import importlib
+import threading
+import socketserver
+import http.client
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+import numpy as np
+
+from utils.result_cache import encode_image
+from utils.startup_profile import profile_startup
+from utils.global_dir_utils import create_dt, GetBoundary, MSCodeSparse
+from utils.stylegan_models import encoder, decoder
+
+# global.py cannot be imported with a plain import statement
+global_dir = importlib.import_module("global")
+
+
+class EditServer(object):
+    """
+    Keeps the generator, CrossModalAlign and style stats resident and renders edit requests.
+    Requests arriving within `window` seconds of each other are rendered in one decoder call.
+    request: dict(latent_id, target, neutral="", method="Baseline", alpha=5, topk=50)
+    """
+    def __init__(self, generator, align_model, args, window=0.01, max_batch=8):
+        self.generator = generator
+        self.align_model = align_model
+        self.args = args
+        self.window = window
+        self.max_batch = max_batch
+        self.latents = torch.load(args.latents_path, map_location='cpu')
+        self.styles = {}
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, request):
+        future = Future()
+        self.requests.put((request, future))
+        return future
+
+    def edit(self, request):
+        return self.submit(request).result()
+
+    def _style(self, latent_id):
+        if latent_id not in self.styles:
+            latent = torch.Tensor(self.latents[latent_id][None]).to(self.args.device)
+            with torch.no_grad():
+                style_space, style_names, noise_constants = encoder(self.generator, latent)
+            self.styles[latent_id] = (latent, style_space, style_names, noise_constants)
+        return self.styles[latent_id]
+
+    def _codes(self, request):
+        latent, style_space, style_names, noise_constants = self._style(int(request['latent_id']))
+        args = argparse.Namespace(**vars(self.args))
+        args.topk = int(request.get('topk', args.topk))
+        target_embedding = create_dt(request['target'], model=self.align_model.model, neutral=request.get('neutral', ""))
+        method = request.get('method', "Baseline")
+        if method=="Baseline":
+            t = target_embedding.detach().cpu().numpy()
+            t = t/np.linalg.norm(t)
+            edit, _, _, _ = GetBoundary(args.s_dict, t.squeeze(axis=0), args, style_space, style_names, sparse=True)
+        elif method=="Random":
+            self.align_model.text_feature = target_embedding
+            edit = self.align_model.cross_modal_edit(style_space, style_names)
+        else:
+            raise ValueError(f"unknown method {method}")
+        codes = MSCodeSparse(style_space, [edit], [float(request.get('alpha', args.alpha))])
+        return codes, latent, noise_constants
+
+    def _serve(self):
+        while True:
+            batch = [self.requests.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self.requests.get(timeout=self.window))
+            except queue.Empty:
+                pass
+            self._render(batch)
+
+    def _render(self, batch):
+        jobs = []
+        for request, future in batch:
+            try:
+                jobs.append((self._codes(request), future))
+            except Exception as e:
+                future.set_exception(e)
+        if not jobs:
+            return
+        try:
+            codes = [torch.cat(c) for c in zip(*[job[0] for job, _ in jobs])]
+            latent = torch.cat([job[1] for job, _ in jobs])
+            with torch.no_grad():
+                img_gen = decoder(self.generator, codes, latent, jobs[0][0][2])
+        except Exception as e:
+            for _, future in jobs:
+                future.set_exception(e)
+            return
+        for img, (_, future) in zip(img_gen.detach().cpu(), jobs):
+            future.set_result(img)
+
+
+class EditHandler(BaseHTTPRequestHandler):
+    # POST /edit with a JSON request body, responds with the rendered PNG
+    def do_POST(self):
+        if self.path != "/edit":
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            body = encode_image(self.server.edit_server.edit(request))
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(edit_server, host="127.0.0.1", port=8000, unix_socket=None):
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        httpd = UnixHTTPServer(unix_socket, EditHandler)
+    else:
+        httpd = ThreadingHTTPServer((host, port), EditHandler)
+    httpd.edit_server = edit_server
+    httpd.serve_forever()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_socket)
+
+
+def edit_request(latent_id, target, neutral="", method="Baseline", alpha=None, topk=None):
+    request = dict(latent_id=latent_id, target=target, neutral=neutral, method=method, alpha=alpha, topk=topk)
+    return {k: v for k, v in request.items() if v is not None}
+
+
+class EditClient(object):
+    """
+    Client of a running server; edit() returns the PNG bytes
+    """
+    def __init__(self, host="127.0.0.1", port=8000, unix_socket=None):
+        self.host, self.port, self.unix_socket = host, port, unix_socket
+
+    def edit(self, latent_id, target, neutral="", method="Baseline", alpha=None, topk=None):
+        """
+        alpha, topk: None leaves them out of the request, so the server's --alpha / --topk apply
+        """
+        conn = UnixHTTPConnection(self.unix_socket) if self.unix_socket else http.client.HTTPConnection(self.host, self.port)
+        body = json.dumps(edit_request(latent_id, target, neutral, method, alpha, topk))
+        conn.request("POST", "/edit", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"{response.status} {response.reason}")
+        return data
+
+
+class LocalClient(EditClient):
+    """
+    In-process stand-in for EditClient that skips the socket
+    """
+    def __init__(self, edit_server):
+        self.edit_server = edit_server
+
+    def edit(self, latent_id, target, neutral="", method="Baseline", alpha=None, topk=None):
+        request = edit_request(latent_id, target, neutral, method, alpha, topk)
+        return encode_image(self.edit_server.edit(request))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Resident styleCLIP Global Direction manipulation server')
+    parser.add_argument('--topk', type=int, default=50, help="Default number of channels to modify")
+    parser.add_argument('--alpha', type=int, default=5, help="Default manipulation strength")
+    parser.add_argument('--beta', type=float, default=0.15, help="Threshold on channel relevance if topk is 0")
+    parser.add_argument('--trg_lambda', type=float, default=0.5, help="weight for preserving the information of target")
+    parser.add_argument('--temperature', type=float, default=1.0, help="Used for bernoulli")
+    parser.add_argument("--stylegan_size", type=int, default=1024, help="StyleGAN resolution")
+    parser.add_argument("--dataset", type=str, default="ffhq", choices=["ffhq", "afhqcat", "afhqdog", "church", 'car'])
+    parser.add_argument("--nsml", action="store_true", help="run on the nsml server")
+    parser.add_argument("--gpu", type=int, default=0)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help="Listen on a unix socket instead of host:port")
+    parser.add_argument("--window", type=float, default=0.01, help="Seconds to wait for requests to batch together")
+    parser.add_argument("--profile-startup", action="store_true", help="Print the import time of the server per module and exit")
+    parser.add_argument("--max_batch", type=int, default=8, help="Maximum number of images per decoder call")
+
+    args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup("server", cwd=os.path.dirname(os.path.abspath(__file__)))
+        sys.exit()
+    args.device = torch.device(f"cuda:{args.gpu}" if torch.cuda.is_available() else 'cpu')
+    args.stylegan_weights = f'../Pretrained/stylegan2/{args.dataset}.pt'
+    args.s_dict_path = f'./dictionary/{args.dataset}/fs3.npy'
+    args.latents_path = f'./latents/{args.dataset}/test_faces.pt'
+
+    generator, align_model, args = global_dir.prepare(args)
+    edit_server = EditServer(generator, align_model, args, window=args.window, max_batch=args.max_batch)
+    serve(edit_server, host=args.host, port=args.port, unix_socket=args.unix_socket)
@@ -1,2 +1,2 @@
-from . import eval_utils, global_dir_utils, stylegan_models
-__all__ = ["eval_utils", "global_dir_utils", "stylegan_models"]
\ No newline at end of file
+from . import eval_utils, global_dir_utils, stylegan_models, style_stats, result_cache, text_cache, startup_profile, density, render_state
+__all__ = ["eval_utils", "global_dir_utils", "stylegan_models", "style_stats", "result_cache", "text_cache", "startup_profile", "density", "render_state"]
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+def lof_1d(x, k=20):
+    """
+    Local outlier factor of every sample of each column of x (n, ) or (n, m), the same score as
+    sklearn's LocalOutlierFactor(n_neighbors=k).fit(column) -negative_outlier_factor_
+    (up to the choice among equidistant neighbors).
+    In one dimension the k nearest neighbors of a sample are a window of k + 1 consecutive
+    sorted values around it, so everything follows from one sort per column.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    squeeze = x.ndim == 1
+    x = x.reshape(len(x), -1)
+    n, m = x.shape
+    k = min(k, n - 1)
+
+    order = np.argsort(x, axis=0, kind='stable')
+    v = np.take_along_axis(x, order, axis=0) # (n, m) sorted
+    i = np.arange(n)[:, None]
+
+    # candidate windows [l, l + k] containing i; the kNN window has the smallest radius
+    starts = np.clip(i - k + np.arange(k + 1)[None, :], 0, n - k - 1) # (n, k + 1)
+    radius = np.maximum(v[:, None, :] - v[starts], v[starts + k] - v[:, None, :]) # (n, k + 1, m)
+    best = np.take_along_axis(starts[:, :, None], radius.argmin(axis=1)[:, None, :], axis=1)[:, 0] # (n, m)
+    k_distance = radius.min(axis=1)
+
+    # neighbors of i: the window without i itself
+    offsets = np.arange(k)[None, :, None]
+    neighbors = best[:, None, :] + offsets
+    neighbors = neighbors + (neighbors >= i[:, :, None]) # (n, k, m)
+    cols = np.arange(m)[None, None, :]
+    dist = np.abs(v[neighbors, cols] - v[:, None, :])
+    reach = np.maximum(k_distance[neighbors, cols], dist)
+    lrd = 1. / (reach.mean(axis=1) + 1e-10)
+    lof = lrd[neighbors, cols].mean(axis=1) / lrd
+
+    # back to the input order
+    scores = np.empty_like(lof)
+    np.put_along_axis(scores, order, lof, axis=0)
+    return scores[:, 0] if squeeze else scores
+
+
+def scott_bandwidth(x, weights=None):
+    """
+    Kernel standard deviation of scipy.stats.gaussian_kde(column, weights=...) for each column of x (n, m):
+    weighted sample std times Scott's factor n_eff ** (-1 / 5)
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(len(x), -1)
+    w = np.ones_like(x) if weights is None else np.asarray(weights, dtype=np.float64).reshape(len(x), -1) * np.ones_like(x)
+    w = w / w.sum(axis=0)
+    neff = 1. / (w ** 2).sum(axis=0)
+    mean = (w * x).sum(axis=0)
+    # np.cov(column, aweights=w) with the unbiased correction
+    cov = (w * (x - mean) ** 2).sum(axis=0) / (1. - (w ** 2).sum(axis=0))
+    return np.sqrt(cov) * neff ** (-1. / 5)
+
+
+def binned_kde(x, weights=None, gridsize=100, bins=1024):
+    """
+    Weighted gaussian KDE of each column of x (n, m) on gridsize points from the column's min to max,
+    with the bandwidth of scipy.stats.gaussian_kde. The weighted samples are linearly binned onto
+    `bins` points and convolved with the kernel by FFT, so the cost does not grow with n * gridsize.
+    Returns:
+        grid, density: (gridsize, m)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x = x.reshape(len(x), -1)
+    n, m = x.shape
+    w = np.ones_like(x) if weights is None else np.asarray(weights, dtype=np.float64).reshape(n, -1) * np.ones_like(x)
+    w = w / w.sum(axis=0)
+    bw = scott_bandwidth(x, w)
+    lo, hi = x.min(axis=0), x.max(axis=0)
+    delta = np.maximum(hi - lo, 1e-12) / (bins - 1)
+
+    # linear binning of every column at once, column j in bins [j * bins, (j + 1) * bins)
+    pos = (x - lo) / delta
+    left = np.clip(np.floor(pos).astype(np.int64), 0, bins - 2)
+    frac = pos - left
+    left = left + np.arange(m) * bins
+    counts = np.bincount(left.ravel(), (w * (1 - frac)).ravel(), minlength=m * bins)
+    counts += np.bincount((left + 1).ravel(), (w * frac).ravel(), minlength=m * bins)
+    counts = counts.reshape(m, bins).T
+
+    # kernel over every offset the grid can reach, so the linear convolution is not truncated
+    offsets = np.arange(-(bins - 1), bins)[:, None] * delta
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2) / (np.sqrt(2 * np.pi) * bw)
+    size = 1 << int(np.ceil(np.log2(3 * bins - 2)))
+    fine = np.fft.irfft(np.fft.rfft(counts, size, axis=0) * np.fft.rfft(kernel, size, axis=0), size, axis=0)
+    fine = fine[bins - 1:2 * bins - 1]
+    # FFT round-off would put spurious peaks in the empty stretches between modes
+    fine[fine < 1e-12 * fine.max(axis=0)] = 0
+
+    # linear interpolation onto the output grid
+    grid = lo + np.linspace(0, 1, gridsize)[:, None] * (hi - lo)
+    pos = np.linspace(0, bins - 1, gridsize)
+    left = np.clip(np.floor(pos).astype(np.int64), 0, bins - 2)
+    frac = (pos - left)[:, None]
+    density = fine[left] * (1 - frac) + fine[left + 1] * frac
+    return grid, density
+
+
+def last_two_peaks(density):
+    """
+    Indices of the last two strict local maxima of each column of density (g, m), as used to place
+    the peripheral and core thresholds. A column with one peak gets it twice; without peaks, the last point
+    """
+    g, m = density.shape
+    peaks = np.zeros_like(density, dtype=bool)
+    peaks[1:-1] = (density[1:-1] > density[:-2]) & (density[1:-1] > density[2:])
+    idx = np.where(peaks, np.arange(g)[:, None], -1)
+    b = idx.max(axis=0)
+    a = np.where(idx == b, -1, idx).max(axis=0)
+    b = np.where(b < 0, g - 1, b)
+    a = np.where(a < 0, b, a)
+    return a, b
@@ -177,6 +177,8 @@ def get_sim(text_embeddings, images_embeddings):
     return logits_per_image
 
 if __name__=="__main__":
+    import clip
+    from criteria.clip_registry import get_clip
     device = f"cuda:0" if torch.cuda.is_available() else "cpu"
     PATH = Path("latents/prototypes")
 
@@ -190,7 +192,7 @@ if __name__=="__main__":
 
     retrieval_emb = []
     txt_emb = []
-    model, preprocess = clip.load('ViT-B/32', device)
+    model, preprocess = get_clip('ViT-B/32', device)
     
     candidates = []   
     for idx, description in enumerate(celebA_text):
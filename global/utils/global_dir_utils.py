@@ -1,9 +1,11 @@
 import clip
-import copy
 import numpy as np
-import pickle
 import torch
+from collections import namedtuple
 from utils.stylegan_models import encoder, decoder
+from utils.style_stats import get_style_stats
+from utils.text_cache import get_text_cache
+from utils.utils import psnr
 
 imagenet_templates = [
     'a bad photo of a {}.',
@@ -88,86 +90,144 @@ imagenet_templates = [
 ]
 
 
-def GetBoundary(fs3, dt, args, style_space, style_names):
+def NormalizeBoundary(ds_imp):
+    """
+    Scale each boundary (row) so that its largest channel has magnitude 1
+    """
+    return ds_imp / np.abs(ds_imp).max(axis=-1, keepdims=True)
+
+def GetBoundaries(fs3, dts, args):
     """
     fs3: collection of predefined style directions for each channel (6048, 512)
+    dts: text directions (N, 512)
+    Returns:
+        normalized boundaries (N, 6048), number of channels kept (N, ), selected channels (N, topk)
     """
-    tmp = np.dot(fs3, dt)
-    if args.topk == 0: 
-        ds_imp = copy.copy(tmp)
-        select = np.abs(tmp)< args.beta
-        num_c = np.sum(~select)
-        ds_imp[select] = 0
-        tmp = np.abs(ds_imp).max()
-        ds_imp /=tmp
-        boundary_tmp2, dlatents = SplitS(ds_imp, style_names, style_space, args.nsml)
-        print('num of channels being manipulated:',num_c)
-        return boundary_tmp2, num_c, dlatents, []
-
-    num_c = args.topk
-    _, idxs = torch.topk(torch.Tensor(np.abs(tmp)), num_c)
+    tmp = np.dot(np.atleast_2d(dts), fs3.T)
     ds_imp = np.zeros_like(tmp)
-    # eps = 1.0
-    for idx in idxs:
-        idx = idx.detach().cpu()
-        # ds_imp[idx] = tmp[idx] + np.random.normal(0.0, eps, (1))
-        ds_imp[idx] = tmp[idx]
-    tmp = np.abs(ds_imp).max()
-    ds_imp/=tmp
-    boundary_tmp2, dlatents=SplitS(ds_imp, style_names, style_space, args.nsml)
-    print('num of channels being manipulated:',num_c)
-    return boundary_tmp2, num_c, dlatents, idxs
-
-def GetBoundary_dir(fs3, m_idxs, m_weights, args, style_space, style_names):
+    if args.topk == 0:
+        select = np.abs(tmp) >= args.beta
+        ds_imp[select] = tmp[select]
+        return NormalizeBoundary(ds_imp), select.sum(axis=1), []
+
+    idxs = np.argpartition(-np.abs(tmp), args.topk - 1, axis=1)[:, :args.topk]
+    np.put_along_axis(ds_imp, idxs, np.take_along_axis(tmp, idxs, axis=1), axis=1)
+    return NormalizeBoundary(ds_imp), np.full(len(tmp), args.topk), idxs
+
+def GetBoundaries_dir(fs3, m_idxs, m_weights):
     """
     fs3: collection of predefined style directions for each channel (6048, 512)
-    m_idxs : channels to manipulate
+    m_idxs : N sets of channels to manipulate (each a list of index groups)
     m_weights : directly pairs to m_idxs
+    Returns:
+        normalized boundaries (N, 6048), number of channels set (N, )
     """
     assert len(m_idxs) == len(m_weights)
+    rows, cols, vals = [], [], []
+    for n, (idxs, weights) in enumerate(zip(m_idxs, m_weights)):
+        assert len(idxs) == len(weights)
+        for i, w in zip(idxs, weights):
+            i = np.asarray(i, dtype=np.int64).reshape(-1)
+            rows.append(np.full(len(i), n))
+            cols.append(i)
+            vals.append(np.asarray(w).reshape(-1))
+    ds_imp = np.zeros((len(m_idxs), fs3.shape[0]), dtype=fs3.dtype)
+    rows = np.concatenate(rows)
+    ds_imp[rows, np.concatenate(cols)] = np.concatenate(vals)
+    return NormalizeBoundary(ds_imp), np.bincount(rows, minlength=len(m_idxs))
 
+def GetBoundary(fs3, dt, args, style_space, style_names, sparse=False):
+    """
+    fs3: collection of predefined style directions for each channel (6048, 512)
+    sparse: return the boundary as a SparseEdit instead of SplitS per-layer arrays
+    """
+    ds_imp, num_c, idxs = GetBoundaries(fs3, dt[None], args)
+    if sparse:
+        boundary_tmp2, dlatents = SparseS(ds_imp[0], style_names, style_space, args.nsml, _dataset(args))
+    else:
+        boundary_tmp2, dlatents = SplitS(ds_imp[0], style_names, style_space, args.nsml, _dataset(args))
+    print('num of channels being manipulated:',num_c[0])
+    return boundary_tmp2, num_c[0], dlatents, idxs[0] if len(idxs) else []
+
+def GetBoundary_dir(fs3, m_idxs, m_weights, args, style_space, style_names, sparse=False):
+    """
+    fs3: collection of predefined style directions for each channel (6048, 512)
+    m_idxs : channels to manipulate
+    m_weights : directly pairs to m_idxs
+    sparse: return the boundary as a SparseEdit instead of SplitS per-layer arrays
+    """
     print("Directly Manipulate the style Space")
 
-    ds_imp = np.zeros_like(fs3)[:, 0]
-    num_c = 0
-    for i in range(len(m_idxs)):
-        idxs = m_idxs[i]
-        for j in range(len(idxs)):
-            idx = int(idxs[j])
-            ds_imp[idx] = m_weights[i][j]
-            num_c += 1
-    tmp = np.abs(ds_imp).max()
-    ds_imp/=tmp
-    boundary_tmp2, dlatents=SplitS(ds_imp, style_names, style_space, args.nsml)
-    print('num of channels being manipulated:',num_c)
-    return boundary_tmp2, num_c, dlatents, idxs
+    ds_imp, num_c = GetBoundaries_dir(fs3, [m_idxs], [m_weights])
+    if sparse:
+        boundary_tmp2, dlatents = SparseS(ds_imp[0], style_names, style_space, args.nsml, _dataset(args))
+    else:
+        boundary_tmp2, dlatents=SplitS(ds_imp[0], style_names, style_space, args.nsml, _dataset(args))
+    print('num of channels being manipulated:',num_c[0])
+    idxs = np.concatenate([np.asarray(i, dtype=np.int64).reshape(-1) for i in m_idxs])
+    return boundary_tmp2, num_c[0], dlatents, idxs
         
-def SplitS(ds_p, style_names, style_space, nsml=False): 
+def _dataset(args):
+    return getattr(args, 'dataset', 'ffhq').lower()
+
+def SplitS(ds_p, style_names, style_space, nsml=False, dataset="ffhq"): 
     """
     Split array of 6048(toRGB ignored) channels into corresponding channel size (into 9088)
+    ds_p: (6048, ) or a batch of boundaries (N, 6048)
     """
     all_ds=[]
     start=0
-    dataset_path = "./npy/ffhq/" if not nsml else "./global/npy/ffhq/"
-    tmp=dataset_path+'S'
-    with open(tmp, "rb") as fp:
-        _, dlatents=pickle.load( fp)
-    tmp=dataset_path+'S_mean_std'
-    with open(tmp, "rb") as fp:
-        m, std=pickle.load( fp)
+    stats = get_style_stats(dataset, nsml)
+    dlatents, std = stats.dlatents, stats.std
 
     for i, name in enumerate(style_names):
         if "torgb" not in name:
             tmp=style_space[i].shape[1]
             end=start+tmp
-            tmp=ds_p[start:end] * std[i]
+            tmp=ds_p[..., start:end] * std[i]
             all_ds.append(tmp)
             start=end
         else:
-            tmp = np.zeros(len(dlatents[i][0]))
+            tmp = np.zeros(ds_p.shape[:-1] + (len(std[i]),))
             all_ds.append(tmp)
     return all_ds, dlatents
 
+class SparseEdit(namedtuple("SparseEdit", ["layers", "channels", "deltas"])):
+    """
+    Style space edit as (layer, channel, delta) triples, deltas already scaled by the channel std
+    """
+    @property
+    def first_layer(self):
+        # decoder start_layer; an empty edit falls back to a full render
+        return int(self.layers.min()) if len(self.layers) else 0
+
+_CHANNEL_INDEX = {}
+
+def ChannelIndex(style_names, style_space):
+    """
+    Route each of the 6048(toRGB ignored) global channels to its (layer, in-channel) of the style space
+    """
+    key = tuple((name, s.shape[-1]) for name, s in zip(style_names, style_space))
+    if key not in _CHANNEL_INDEX:
+        layers, channels = [], []
+        for i, (name, size) in enumerate(key):
+            if "torgb" not in name:
+                layers.append(np.full(size, i))
+                channels.append(np.arange(size))
+        _CHANNEL_INDEX[key] = (np.concatenate(layers), np.concatenate(channels))
+    return _CHANNEL_INDEX[key]
+
+def SparseS(ds_p, style_names, style_space, nsml=False, dataset="ffhq"):
+    """
+    Sparse counterpart of SplitS: only the non-zero channels of a 6048 boundary, as a SparseEdit
+    """
+    stats = get_style_stats(dataset, nsml)
+    layer_of, channel_of = ChannelIndex(style_names, style_space)
+    idxs = np.flatnonzero(ds_p)
+    layers, channels = layer_of[idxs], channel_of[idxs]
+    deltas = ds_p[idxs] * stats.std_flat[stats.offsets[layers] + channels]
+    return SparseEdit(layers, channels, deltas), stats.dlatents
+
 def MSCode(dlatent_tmp, boundary_tmp, alpha, device):
     """
     dlatent_tmp: W mapped into style space S
@@ -223,55 +283,188 @@ def MSCode2(dlatent_tmp, boundary_tmp, boundary_tmp2, alpha, beta, device):
         codes.append(code.cuda())
     return codes
 
-def zeroshot_classifier(classnames, model):
+def MSCodeTorch(style_space, boundaries, alphas):
     """
-    model: CLIP 
+    style_space: W mapped into style space S, kept on its device
+    boundaries: Manipulation vectors (SplitS outputs)
+    alphas: Manipulation strength for each boundary, either a scalar or a sweep of K strengths
+    Returns:
+        manipulated Style Space, ready for the decoder ((K, C) per layer for a sweep)
+    """
+    sizes = [s.shape[-1] for s in style_space]
+    ref = style_space[0]
+    delta = 0
+    for boundary, alpha in zip(boundaries, alphas):
+        # one host to device copy per boundary instead of one per layer
+        tmp = torch.from_numpy(np.concatenate(boundary, axis=-1)).to(device=ref.device, dtype=ref.dtype)
+        alpha = torch.as_tensor(alpha, device=ref.device, dtype=ref.dtype)
+        if alpha.ndim:
+            alpha = alpha.view(-1, 1)
+        delta = delta + alpha * tmp
+    return [s + d for s, d in zip(style_space, torch.split(delta, sizes, dim=-1))]
+
+def MSCodeSparse(style_space, edits, alphas):
     """
+    style_space: W mapped into style space S, kept on its device
+    edits: SparseEdit manipulations
+    alphas: Manipulation strength for each edit, either a scalar or a sweep of K strengths
+    Returns:
+        manipulated Style Space; only the layers an edit touches are copied, the rest are shared
+    """
+    ref = style_space[0]
+    codes = list(style_space)
+    for edit, alpha in zip(edits, alphas):
+        alpha = torch.as_tensor(alpha, device=ref.device, dtype=ref.dtype).view(-1, 1)
+        for layer in np.unique(edit.layers):
+            select = edit.layers == layer
+            channels = torch.from_numpy(edit.channels[select]).to(ref.device)
+            deltas = torch.from_numpy(edit.deltas[select]).to(device=ref.device, dtype=ref.dtype)
+            code = codes[layer]
+            if code is style_space[layer] or code.shape[0] < len(alpha):
+                code = code.repeat(len(alpha) // code.shape[0], 1)
+            codes[layer] = code.index_add_(1, channels, (alpha * deltas).expand(code.shape[0], -1))
+    return codes
+
+def MSCodeBatch(style_space, boundary, alpha):
+    """
+    style_space: W+ batch of L latents mapped into style space S, (L, C) per layer
+    boundary: J Manipulation vectors (SplitS output of a (J, 6048) batch)
+    Returns:
+        manipulated Style Space of every latent/boundary pair, (L*J, C) per layer in latent-major order
+    """
+    sizes = [s.shape[-1] for s in style_space]
+    ref = style_space[0]
+    delta = torch.from_numpy(np.concatenate(boundary, axis=-1)).to(device=ref.device, dtype=ref.dtype)
+    delta = torch.split(alpha * delta, sizes, dim=-1)
+    return [(s[:, None] + d[None]).reshape(-1, s.shape[-1]) for s, d in zip(style_space, delta)]
+
+def decode_batches(generator, style_space, latent, noise_constants, batch_size, decode=None, max_res=None):
+    """
+    Render a batch of style codes (B, C) with latents (B, 18, 512) through the decoder,
+    batch_size samples at a time to bound memory.
+    decode: decoder(G, ...) by default, or a CompiledDecoder of the generator
+    max_res: preview resolution, see decoder
+    Yields (start index, generated images) for each chunk
+    """
+    decode = decode if decode is not None else (lambda *inputs, **kwargs: decoder(generator, *inputs, **kwargs))
+    total = style_space[0].shape[0]
+    for start in range(0, total, batch_size):
+        end = min(start + batch_size, total)
+        with torch.no_grad():
+            img_gen = decode([s[start:end] for s in style_space], latent[start:end], noise_constants, max_res=max_res)
+        yield start, img_gen
+
+def encode_text_tokens(model, tokens):
+    """
+    CLIP encode_text truncated to the longest prompt in tokens. Causal attention makes the
+    features at each end-of-text token independent of the padding after it, so the result is
+    that of model.encode_text at a fraction of the 77 token context
+    """
+    if not hasattr(model, 'transformer'):
+        return model.encode_text(tokens)
+    length = int(tokens.argmax(dim=-1).max()) + 1
+    x = model.token_embedding(tokens[:, :length]).type(model.dtype)
+    x = x + model.positional_embedding[:length].type(model.dtype)
+    x = x.permute(1, 0, 2)  # NLD -> LND
+    mask = torch.full((length, length), float("-inf"), device=x.device).triu_(1).to(x.dtype)
+    for block in model.transformer.resblocks:
+        y = block.ln_1(x)
+        x = x + block.attn(y, y, y, need_weights=False, attn_mask=mask)[0]
+        x = x + block.mlp(block.ln_2(x))
+    x = x.permute(1, 0, 2)  # LND -> NLD
+    x = model.ln_final(x).type(model.dtype)
+    return x[torch.arange(x.shape[0]), tokens.argmax(dim=-1)] @ model.text_projection
+
+def encode_templates(classnames, model, templates=imagenet_templates, chunk_size=256, sort_by_length=True):
+    """
+    Template-averaged normalized embeddings (len(classnames), D).
+    All (class, template) prompts are encoded chunk_size at a time, sorted by token length so that
+    each chunk is truncated to its own longest prompt, and reduced per class with one segment mean
+    """
+    device = next(model.parameters()).device
+    texts = [template.format(classname) for classname in classnames for template in templates] #format with class
+    tokens = clip.tokenize(texts) #tokenize
+    segments = torch.arange(len(classnames), device=device).repeat_interleave(len(templates))
+    order = torch.argsort(tokens.argmax(dim=-1)) if sort_by_length else torch.arange(len(texts))
     with torch.no_grad():
-        zeroshot_weights = []
-        for classname in classnames:
-            texts = [template.format(classname) for template in imagenet_templates] #format with class
-            texts = clip.tokenize(texts).cuda() #tokenize
-            class_embeddings = model.encode_text(texts) #embed with text encoder
-            class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
-            class_embedding = class_embeddings.mean(dim=0)
-            class_embedding /= class_embedding.norm()
-            zeroshot_weights.append(class_embedding)
-        zeroshot_weights = torch.stack(zeroshot_weights, dim=1).cuda()
-    return zeroshot_weights
-
-def create_dt(target, model, neutral=""):
-    text_features = zeroshot_classifier([target, neutral], model).T
+        embeddings = []
+        for start in range(0, len(texts), chunk_size):
+            chunk = tokens[order[start:start + chunk_size]].to(device)
+            embeddings.append(encode_text_tokens(model, chunk).float()) #embed with text encoder
+        embeddings = torch.cat(embeddings)
+        embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+        class_embeddings = torch.zeros(len(classnames), embeddings.shape[1], device=device)
+        class_embeddings.index_add_(0, segments[order.to(device)], embeddings)
+        class_embeddings /= torch.bincount(segments, minlength=len(classnames))[:, None]
+    return class_embeddings / class_embeddings.norm(dim=-1, keepdim=True)
+
+def zeroshot_classifier(classnames, model, model_name="ViT-B/32", templates=imagenet_templates, cache=None):
+    """
+    model: CLIP 
+    Template-averaged embeddings are served from the text embedding cache (get_text_cache by default);
+    the templates of all misses are encoded together with encode_templates
+    Returns:
+        (D, len(classnames)) on the device of model
+    """
+    cache = cache if cache is not None else get_text_cache()
+    zeroshot_weights = cache.lookup(classnames, model_name, templates, lambda names: encode_templates(names, model, templates), dtype=model.text_projection.dtype)
+    return zeroshot_weights.T.to(next(model.parameters()).device)
+
+def create_dt(target, model, neutral="", model_name="ViT-B/32"):
+    text_features = zeroshot_classifier([target, neutral], model, model_name).T
     dt = text_features[0]-text_features[1]
     dt = dt / dt.norm()
     return dt.unsqueeze(0).float()
 
-def create_image_S(generator, latent):
+def create_image_S(generator, latent, cache=None):
+    """
+    cache: optional empty dict, filled with the decoder activations of the original image
+        so that manipulate_image* can skip the layers an edit leaves unchanged
+    """
     with torch.no_grad():
         style_space, style_names, noise_constants = encoder(generator, latent)
-        img_orig = decoder(generator, style_space, latent, noise_constants)
+        img_orig = decoder(generator, style_space, latent, noise_constants, cache=cache)
     return img_orig, style_space, style_names, noise_constants
 
-def manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=5, t=None, s_dict=None, device="cuda:0"):
-    boundary_tmp2, _, _, _ = GetBoundary(s_dict, t.squeeze(axis=0), args, style_space, style_names) # Move each channel by dStyle
-    dlatents_loaded = [s.cpu().detach().numpy() for s in style_space]
-    manip_codes= MSCode(dlatents_loaded, boundary_tmp2, [alpha], device)
-    img_gen = decoder(generator, manip_codes, latent, noise_constants)
+def precision_check(generator, style_space, latent, noise_constants, dtype, align_model=None):
+    """
+    Quality guardrail of the reduced precision decoder: deviation from the float32 render
+    Returns:
+        dict with psnr and (with align_model) the CLIP similarity of both renders
+    """
+    with torch.no_grad():
+        img_ref = decoder(generator, style_space, latent, noise_constants, dtype=torch.float32)
+        img_low = decoder(generator, style_space, latent, noise_constants, dtype=dtype)
+        report = {'psnr': psnr(img_ref, img_low)}
+        if align_model is not None:
+            sim = (align_model.encode_image(img_ref) * align_model.encode_image(img_low)).sum(dim=-1)
+            report['clip_sim'] = sim.min().item()
+    return report
+
+def manipulate_image(style_space, style_names, noise_constants, generator, latent, args, alpha=5, t=None, s_dict=None, device="cuda:0", cache=None):
+    """
+    alpha: Manipulation strength, or a list of K strengths rendered in one decoder call (K, 3, H, W)
+    cache: decoder activations filled by create_image_S for the same latent
+    """
+    edit, _, _, _ = GetBoundary(s_dict, t.squeeze(axis=0), args, style_space, style_names, sparse=True) # Move each channel by dStyle
+    manip_codes= MSCodeSparse(style_space, [edit], [alpha])
+    start_layer = edit.first_layer if cache else 0
+    img_gen = decoder(generator, manip_codes, latent, noise_constants, cache=cache, start_layer=start_layer)
     return img_gen, manip_codes, style_space
 
 # Directly manipulate without dot product
-def manipulate_image_dir(style_space, style_names, noise_constants, generator, latent, args, alpha=5, m_idxs=None, m_weights=None, s_dict=None, device="cuda:0"):
-    boundary_tmp2, _, _, _ = GetBoundary_dir(s_dict, m_idxs, m_weights, args, style_space, style_names) # Move each channel by dStyle
-    dlatents_loaded = [s.cpu().detach().numpy() for s in style_space]
-    manip_codes= MSCode(dlatents_loaded, boundary_tmp2, [alpha], device)
-    img_gen = decoder(generator, manip_codes, latent, noise_constants)
+def manipulate_image_dir(style_space, style_names, noise_constants, generator, latent, args, alpha=5, m_idxs=None, m_weights=None, s_dict=None, device="cuda:0", cache=None):
+    edit, _, _, _ = GetBoundary_dir(s_dict, m_idxs, m_weights, args, style_space, style_names, sparse=True) # Move each channel by dStyle
+    manip_codes= MSCodeSparse(style_space, [edit], [alpha])
+    start_layer = edit.first_layer if cache else 0
+    img_gen = decoder(generator, manip_codes, latent, noise_constants, cache=cache, start_layer=start_layer)
     return img_gen, manip_codes, style_space
 
 # Interpolate between two text embeddings
-def manipulate_image2(style_space, style_names, noise_constants, generator, latent, args, alpha=5, beta=5, t=None, t2= None, s_dict=None, device="cuda:0"):
-    boundary_tmp2, _, _, _ = GetBoundary(s_dict, t.squeeze(axis=0), args, style_space, style_names) # Move each channel by dStyle
-    boundary_tmp22, _, _, _ = GetBoundary(s_dict, t2.squeeze(axis=0), args, style_space, style_names) # Move each channel by dStyle
-    dlatents_loaded = [s.cpu().detach().numpy() for s in style_space]
-    manip_codes= MSCode2(dlatents_loaded, boundary_tmp2, boundary_tmp22, [alpha], [beta], device)
-    img_gen = decoder(generator, manip_codes, latent, noise_constants)
+def manipulate_image2(style_space, style_names, noise_constants, generator, latent, args, alpha=5, beta=5, t=None, t2= None, s_dict=None, device="cuda:0", cache=None):
+    edit, _, _, _ = GetBoundary(s_dict, t.squeeze(axis=0), args, style_space, style_names, sparse=True) # Move each channel by dStyle
+    edit2, _, _, _ = GetBoundary(s_dict, t2.squeeze(axis=0), args, style_space, style_names, sparse=True) # Move each channel by dStyle
+    manip_codes= MSCodeSparse(style_space, [edit, edit2], [alpha, beta])
+    start_layer = min(edit.first_layer, edit2.first_layer) if cache else 0
+    img_gen = decoder(generator, manip_codes, latent, noise_constants, cache=cache, start_layer=start_layer)
     return img_gen, manip_codes, style_space
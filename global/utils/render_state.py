@@ -0,0 +1,44 @@
+from collections import OrderedDict, namedtuple
+
+import torch
+
+from utils.global_dir_utils import create_image_S
+
+RenderState = namedtuple('RenderState', ['latent', 'style_space', 'style_names', 'noise_constants', 'img_orig', 'image_feature', 'prefix_cache'])
+
+
+class RenderStateCache(object):
+    """
+    Everything an edit needs that depends only on the latent: its style space, noise,
+    the original render and the CLIP feature of that render, computed once per latent id
+    and kept in a small LRU.
+    prefix_cache: also keep the decoder activations of the original render for manipulate_image*
+        (hundreds of MB per latent at 1024px); otherwise state.prefix_cache is None
+    """
+    def __init__(self, generator, align_model, max_size=4, prefix_cache=False):
+        self.generator = generator
+        self.align_model = align_model
+        self.max_size = max_size
+        self.prefix_cache = prefix_cache
+        self.states = OrderedDict()
+
+    def get(self, latent_id, latent):
+        """
+        latent_id: hashable id of the latent (e.g. its index in the latents file)
+        latent: W+ code (1, 18, 512) on the generator's device
+        """
+        if latent_id in self.states:
+            self.states.move_to_end(latent_id)
+            return self.states[latent_id]
+        prefix_cache = {} if self.prefix_cache else None
+        img_orig, style_space, style_names, noise_constants = create_image_S(self.generator, latent, cache=prefix_cache)
+        with torch.no_grad():
+            image_feature = self.align_model.encode_image(img_orig)
+        state = RenderState(latent, style_space, style_names, noise_constants, img_orig, image_feature, prefix_cache)
+        self.states[latent_id] = state
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+        return state
+
+    def clear(self):
+        self.states.clear()
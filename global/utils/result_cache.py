@@ -0,0 +1,160 @@
+import io
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from torchvision.utils import save_image
+import torchvision.transforms.functional as F
+
+
+def encode_image(img):
+    """
+    img: generated image (3, H, W) in [-1, 1] -> PNG bytes
+    """
+    buf = io.BytesIO()
+    save_image(img, buf, format='png', normalize=True, value_range=(-1, 1))
+    return buf.getvalue()
+
+def decode_image(png):
+    """
+    PNG bytes -> image (3, H, W) in [-1, 1]
+    """
+    img = Image.open(io.BytesIO(png)).convert('RGB')
+    return F.to_tensor(img) * 2 - 1
+
+def checkpoint_fingerprint(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def tensor_fingerprint(x):
+    """
+    Hash of a tensor's shape, dtype and values, e.g. to key on a latent itself rather than its index
+    """
+    x = x.detach().cpu().contiguous()
+    return hashlib.sha256(f"{tuple(x.shape)}:{x.dtype}:".encode() + x.numpy().tobytes()).hexdigest()
+
+def _write(path, data):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ResultCache(object):
+    """
+    Content-addressed on-disk cache of rendered edits with size-bounded LRU eviction.
+    Entries are keyed by a hash of the edit inputs (latent, target, neutral, method, alpha, topk, beta, dataset),
+    the generator checkpoint and the other input files (e.g. fs3.npy, the latents file),
+    and hold the encoded image and optionally the sparse style delta.
+    Concurrent requests for the same key in this process are computed once.
+    """
+    def __init__(self, root, checkpoint, max_bytes=2**30, inputs=()):
+        self.root = root
+        self.checkpoint = checkpoint_fingerprint(checkpoint)
+        self.inputs = [checkpoint_fingerprint(path) for path in inputs]
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.inflight = {}
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(os.path.getsize(p) for p in self._files())
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(dirpath, name)
+
+    def _path(self, key, ext):
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    def key(self, **fields):
+        fields = dict(fields, checkpoint=self.checkpoint, inputs=self.inputs)
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns (png, delta) or None; delta is a dict of layers/channels/deltas arrays if stored
+        """
+        path = self._path(key, 'png')
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            return None
+        delta = None
+        if os.path.exists(self._path(key, 'npz')):
+            with np.load(self._path(key, 'npz')) as npz:
+                delta = {k: npz[k] for k in npz.files}
+        return png, delta
+
+    def put(self, key, png, delta=None):
+        """
+        delta: optional SparseEdit (or dict with layers, channels, deltas) stored next to the image
+        """
+        os.makedirs(os.path.dirname(self._path(key, 'png')), exist_ok=True)
+        added = len(png)
+        if delta is not None:
+            buf = io.BytesIO()
+            delta = delta._asdict() if hasattr(delta, '_asdict') else delta
+            np.savez(buf, **delta)
+            _write(self._path(key, 'npz'), buf.getvalue())
+            added += buf.tell()
+        # image last: its presence marks a complete entry
+        _write(self._path(key, 'png'), png)
+        with self.lock:
+            self.size += added
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = list(self._files())
+        self.size = sum(os.path.getsize(p) for p in files)
+        # least recently used entries first, image and delta together
+        for path in sorted([p for p in files if p.endswith('.png')], key=os.path.getmtime):
+            if self.size <= self.max_bytes:
+                break
+            for p in [path, path[:-len('png')] + 'npz']:
+                if os.path.exists(p):
+                    self.size -= os.path.getsize(p)
+                    os.remove(p)
+
+    def get_or_compute(self, fields, compute):
+        """
+        fields: edit inputs hashed into the key
+        compute: returns (png, delta) on a miss; only one caller per key runs it at a time
+        """
+        key = self.key(**fields)
+        while True:
+            hit = self.get(key)
+            if hit is not None:
+                return hit
+            with self.lock:
+                event = self.inflight.get(key)
+                if event is None:
+                    event = self.inflight[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            # a previous owner may have finished between the miss and taking ownership
+            hit = self.get(key)
+            if hit is not None:
+                return hit
+            png, delta = compute()
+            self.put(key, png, delta)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+        return png, delta
+
+    def render(self, fields, render, device='cpu'):
+        """
+        render: returns a generated image (1, 3, H, W); cached as PNG
+        Returns:
+            image (1, 3, H, W) in [-1, 1]
+        """
+        png, _ = self.get_or_compute(fields, lambda: (encode_image(render()), None))
+        return decode_image(png)[None].to(device)
@@ -0,0 +1,42 @@
+import os
+import sys
+import subprocess
+
+
+def import_times(module, cwd=None):
+    """
+    Import module in a fresh interpreter with -X importtime
+    Returns:
+        list of (name, self us, cumulative us, depth) in import order
+    """
+    code = f"import sys; sys.path.insert(0, {cwd or os.getcwd()!r}); __import__({module!r})"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=cwd, capture_output=True, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+    return times
+
+
+def profile_startup(module, cwd=None, top=20):
+    """
+    Print the import time of module broken down by the modules it imports directly
+    (each including everything it pulls in first), slowest first
+    """
+    times = import_times(module, cwd)
+    end = next((i for i, t in enumerate(times) if t[0] == module and t[3] == 0), None)
+    if end is None:
+        return
+    # children are reported before their parent: the direct imports follow the previous top-level module
+    start = max([i + 1 for i, t in enumerate(times[:end]) if t[3] == 0], default=0)
+    total = times[end][2]
+    direct = [t for t in times[start:end] if t[3] == 1]
+    print(f"import {module}: {total / 1e6:.2f}s")
+    print(f"{'module':<40}{'cumulative [s]':>16}{'share':>8}")
+    for name, _, cumulative_us, _ in sorted(direct, key=lambda t: -t[2])[:top]:
+        print(f"{name:<40}{cumulative_us / 1e6:>16.3f}{cumulative_us / max(total, 1):>8.1%}")
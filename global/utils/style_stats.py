@@ -0,0 +1,84 @@
+import os
+import pickle
+import numpy as np
+
+_STORE = {}
+
+class StyleStats(object):
+    """
+    Style space statistics of a dataset (sampled S, per-channel mean and std)
+    backed by memory-mapped arrays so that worker processes share the pages.
+        dlatents: list of per-layer views (num_samples, C) into S
+        mean, std: list of per-layer views (C, )
+        std_flat: std of all layers concatenated, indexed by offsets[layer] + channel
+    """
+    def __init__(self, root):
+        self.root = root
+        offsets = np.load(os.path.join(root, 'offsets.npy'))
+        S = np.load(os.path.join(root, 'S.npy'), mmap_mode='r')
+        mean = np.load(os.path.join(root, 'mean.npy'), mmap_mode='r')
+        std = np.load(os.path.join(root, 'std.npy'), mmap_mode='r')
+        self.offsets = offsets
+        self.std_flat = std
+        self.dlatents = [S[:, s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+        self.mean = [mean[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+        self.std = [std[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+def _save(path, arr):
+    # write then rename so that concurrent workers never see a partial file
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+def convert_style_stats(dataset_path, root):
+    """
+    Convert the pickled S and S_mean_std into flat .npy arrays under root
+    """
+    with open(os.path.join(dataset_path, 'S'), "rb") as fp:
+        _, dlatents = pickle.load(fp)
+    with open(os.path.join(dataset_path, 'S_mean_std'), "rb") as fp:
+        m, std = pickle.load(fp)
+
+    sizes = [np.shape(d)[-1] for d in dlatents]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    os.makedirs(root, exist_ok=True)
+    _save(os.path.join(root, 'S.npy'), np.concatenate([np.asarray(d, dtype=np.float32) for d in dlatents], axis=1))
+    _save(os.path.join(root, 'mean.npy'), np.concatenate([np.asarray(x, dtype=np.float32).reshape(-1) for x in m]))
+    _save(os.path.join(root, 'std.npy'), np.concatenate([np.asarray(x, dtype=np.float32).reshape(-1) for x in std]))
+    # offsets last: its presence marks a complete conversion
+    _save(os.path.join(root, 'offsets.npy'), offsets)
+
+def style_stats_path(dataset="ffhq", nsml=False):
+    """
+    Directory of the S / S_mean_std pickles of dataset. Only npy/ffhq is distributed (see README);
+    like the original SplitS, datasets without their own statistics use the ffhq ones
+    """
+    base = "./npy" if not nsml else "./global/npy"
+    dataset_path = os.path.join(base, dataset)
+    if not os.path.exists(os.path.join(dataset_path, 'S_mean_std')) and not os.path.exists(os.path.join(dataset_path, 'mmap', 'offsets.npy')):
+        dataset_path = os.path.join(base, 'ffhq')
+    return dataset_path
+
+def style_stats_files(dataset="ffhq", nsml=False):
+    """
+    Source file of the channel std of dataset (the S_mean_std pickle, or its conversion when only
+    that is present), e.g. to key cached renders on it
+    """
+    dataset_path = style_stats_path(dataset, nsml)
+    files = [os.path.join(dataset_path, 'S_mean_std'), os.path.join(dataset_path, 'mmap', 'std.npy')]
+    return [path for path in files if os.path.exists(path)][:1]
+
+def get_style_stats(dataset="ffhq", nsml=False):
+    """
+    Process-wide store of style statistics, loaded once per statistics directory
+    """
+    dataset_path = style_stats_path(dataset, nsml)
+    key = os.path.abspath(dataset_path)
+    if key not in _STORE:
+        root = os.path.join(dataset_path, 'mmap')
+        offsets, source = os.path.join(root, 'offsets.npy'), os.path.join(dataset_path, 'S_mean_std')
+        # (re)convert when missing or older than the pickles
+        if not os.path.exists(offsets) or (os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(offsets)):
+            convert_style_stats(dataset_path, root)
+        _STORE[key] = StyleStats(root)
+    return _STORE[key]
@@ -1,97 +1,248 @@
 import torch
-import  torch.nn.functional as F
+
+from models.stylegan2.models import Generator
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+def modulated_conv(conv, input, style):
+    """
+    Modulated convolution with a style space code; see ModulatedConv2d.modulated
+    """
+    return conv.modulated(input, style)
 
 def conv_warper(layer, input, style, noise):
     # the conv should change
-    conv = layer.conv
-    batch, in_channel, height, width = input.shape
-    style = style.view(batch, 1, in_channel, 1, 1)
-    weight = conv.scale * conv.weight * style
-
-    if conv.demodulate:
-        demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
-        weight = weight * demod.view(batch, conv.out_channel, 1, 1, 1)
-
-    weight = weight.view(
-        batch * conv.out_channel, in_channel, conv.kernel_size, conv.kernel_size
-    )
-
-    if conv.upsample: # up==2
-        input = input.view(1, batch * in_channel, height, width)
-        weight = weight.view(
-            batch, conv.out_channel, in_channel, conv.kernel_size, conv.kernel_size
-        )
-        weight = weight.transpose(1, 2).reshape(
-            batch * in_channel, conv.out_channel, conv.kernel_size, conv.kernel_size
-        )
-        out = F.conv_transpose2d(input, weight, padding=0, stride=2, groups=batch)
-        _, _, height, width = out.shape
-        out = out.view(batch, conv.out_channel, height, width)
-        out = conv.blur(out)
-
-    elif conv.downsample:
-        input = conv.blur(input)
-        _, _, height, width = input.shape
-        input = input.view(1, batch * in_channel, height, width)
-        out = F.conv2d(input, weight, padding=0, stride=2, groups=batch)
-        _, _, height, width = out.shape
-        out = out.view(batch, conv.out_channel, height, width)
-
+    out = modulated_conv(layer.conv, input, style)
+    if noise is None:
+        out = layer.noise(out, noise=noise)
     else:
-        input = input.view(1, batch * in_channel, height, width)
-        out = F.conv2d(input, weight, padding=conv.padding, groups=batch)
-        _, _, height, width = out.shape
-        out = out.view(batch, conv.out_channel, height, width)
-    out = layer.noise(out, noise=noise)
+        # NoiseInjection without promoting low precision activations to float32
+        out = out + (layer.noise.weight * noise).to(out.dtype)
     out = layer.activate(out)
     
     return out
 
-def decoder(G, style_space, latent, noise):
+def torgb_warper(to_rgb, input, style, skip=None):
+    """
+    ToRGB of (possibly low precision) activations, accumulated into the float32 skip image
+    """
+    out = modulated_conv(to_rgb.conv, input, to_rgb.conv.modulation(style)).float()
+    out = out + to_rgb.bias
+
+    if skip is not None:
+        skip = to_rgb.upsample(skip)
+
+        out = out + skip
+
+    return out
+
+def _expand(x, batch):
+    return None if x is None else x.expand(batch, *x.shape[1:])
+
+def decoder(G, style_space, latent, noise, cache=None, start_layer=0, dtype=None, max_res=None):
     """
     Returns array of generated image from manipulated style space
+    Styles with a batch of K (e.g. an alpha sweep) are rendered together,
+    broadcasting single-sample styles and latent over the batch
+    cache: dict of the (out, skip) activations entering each conv layer, keyed by style index.
+        An empty dict is filled by this call (render the unedited image);
+        otherwise rendering resumes from the deepest cached layer <= start_layer
+    start_layer: first style layer that differs from the cached image
+    dtype: activation dtype of the convolutions (e.g. torch.bfloat16), G.decode_dtype if not given;
+        the image is accumulated in float32
+    max_res: preview, stop after this resolution and return the RGB accumulated so far
     """
+    dtype = dtype if dtype is not None else getattr(G, 'decode_dtype', None)
+    style_space = [s.reshape(-1, s.shape[-1]) for s in style_space]
+    batch = max(s.shape[0] for s in style_space)
+    style_space = [s.expand(batch, -1) for s in style_space]
+    latent = latent.expand(batch, -1, -1)
 
-    out = G.input(latent)
+    fill = cache is not None and len(cache) == 0
+    resume = 0
+    if cache and start_layer > 0:
+        resume = max(i for i in cache if i <= start_layer)
 
-    out = conv_warper(G.conv1, out, style_space[0], noise[0])
-    skip = G.to_rgb1(out, latent[:, 0])
+    if resume == 0:
+        out = G.input(latent)
+        if dtype is not None:
+            out = out.to(dtype)
+        if fill:
+            cache[0] = (out, None)
+        out = conv_warper(G.conv1, out, style_space[0], noise[0])
+        skip = torgb_warper(G.to_rgb1, out, latent[:, 0])
+    else:
+        out, skip = [_expand(x, batch) for x in cache[resume]]
 
-    i = 2; j = 1
+    i = 2; j = 1; res = 8
     for conv1, conv2, noise1, noise2, to_rgb in zip(
         G.convs[::2], G.convs[1::2], noise[1::2], noise[2::2], G.to_rgbs
     ):
-        out = conv_warper(conv1, out, style_space[i], noise=noise1)
-        out = conv_warper(conv2, out, style_space[i+1], noise=noise2)
-        skip = to_rgb(out,  latent[:, j + 2], skip)
+        if max_res is not None and res > max_res:
+            break
+        if i + 1 >= resume:
+            if i >= resume:
+                if fill:
+                    cache[i] = (out, skip)
+                out = conv_warper(conv1, out, style_space[i], noise=noise1)
+            if fill:
+                cache[i + 1] = (out, skip)
+            out = conv_warper(conv2, out, style_space[i+1], noise=noise2)
+            skip = torgb_warper(to_rgb, out, latent[:, j + 2], skip)
 
-        i += 3; j += 2
+        i += 3; j += 2; res *= 2
 
     image = skip
 
     return image
 
-def encoder(G, latent): 
+class _DecoderGraph(torch.nn.Module):
+    # decoder over flat tuples of style and noise tensors, the unit that is compiled
+    def __init__(self, G, dtype=None, max_res=None):
+        super().__init__()
+        self.G = G
+        self.dtype = dtype
+        self.max_res = max_res
+
+    def forward(self, latent, style_space, noise):
+        return decoder(self.G, list(style_space), latent, list(noise), dtype=self.dtype, max_res=self.max_res)
+
+class CompiledDecoder(object):
+    """
+    Drop-in for decoder(G, style_space, latent, noise) with the layer loop compiled by
+    torch.compile (or traced with TorchScript when torch.compile is unavailable).
+    Graphs are built lazily and cached per (resolution, batch size, dtype, max_res); a graph that fails
+    to build or run is disabled and that key renders with the eager decoder from then on.
+    Calls using the prefix cache (cache / start_layer) always run eagerly.
+    backend: "compile", "script" or "eager"; by default the best available
+    """
+    def __init__(self, G, backend=None):
+        if backend is None:
+            backend = "compile" if hasattr(torch, "compile") else "script"
+        self.G = G
+        self.backend = backend
+        self.graphs = {}
+
+    def _build(self, dtype, max_res, inputs):
+        graph = _DecoderGraph(self.G, dtype, max_res)
+        if self.backend == "compile":
+            return torch.compile(graph, dynamic=False)
+        if self.backend == "script":
+            with torch.no_grad():
+                return torch.jit.trace(graph, inputs, check_trace=False)
+        return None
+
+    def __call__(self, style_space, latent, noise, cache=None, start_layer=0, dtype=None, max_res=None):
+        dtype = dtype if dtype is not None else getattr(self.G, 'decode_dtype', None)
+        if cache is not None or self.backend == "eager":
+            return decoder(self.G, style_space, latent, noise, cache=cache, start_layer=start_layer, dtype=dtype, max_res=max_res)
+
+        # fixed shapes: one graph per batch size
+        style_space = [s.reshape(-1, s.shape[-1]) for s in style_space]
+        batch = max(max(s.shape[0] for s in style_space), latent.shape[0])
+        inputs = (latent.expand(batch, -1, -1).contiguous(),
+                  tuple(s.expand(batch, -1).contiguous() for s in style_space),
+                  tuple(noise))
+        key = (self.G.size, batch, dtype, max_res)
+        if key not in self.graphs:
+            try:
+                self.graphs[key] = self._build(dtype, max_res, inputs)
+            except Exception as e:
+                print(f"CompiledDecoder: {self.backend} failed for {key}, using eager decoder ({type(e).__name__})")
+                self.graphs[key] = None
+        graph = self.graphs[key]
+        if graph is not None:
+            try:
+                return graph(*inputs)
+            except Exception as e:
+                # torch.compile builds on the first call, so failures can surface here
+                print(f"CompiledDecoder: {self.backend} failed for {key}, using eager decoder ({type(e).__name__})")
+                self.graphs[key] = None
+        return decoder(self.G, style_space, latent, noise, dtype=dtype, max_res=max_res)
+
+def preview_generator(state_dict, max_res, style_dim=512, n_mlp=8, channel_multiplier=2):
+    """
+    Generator truncated at max_res: only the blocks up to max_res are built and loaded from
+    the full resolution state_dict. Decodes the style space of the full generator (the extra
+    layers are ignored) at the cost of a max_res render
+    """
+    G = Generator(max_res, style_dim, n_mlp, channel_multiplier=channel_multiplier)
+    keys = G.state_dict().keys()
+    G.load_state_dict({k: v for k, v in state_dict.items() if k in keys})
+    return G
+
+def _style_layers(G):
+    """
+    (modulation, w+ index, name) of each style space layer, in the order of encoder
+    """
+    layers = [(G.conv1.conv.modulation, 0, "b4/conv1"), (G.to_rgbs[0].conv.modulation, 0, "b4/torgb")]
+    i = 1; res = 8
+    for conv1, conv2, to_rgb in zip(G.convs[::2], G.convs[1::2], G.to_rgbs):
+        layers.append((conv1.conv.modulation, i, f"b{res}/conv1"))
+        layers.append((conv2.conv.modulation, i + 1, f"b{res}/conv2"))
+        layers.append((to_rgb.conv.modulation, i + 2, f"b{res}/torgb"))
+        i += 2; res *= 2
+    return layers
+
+def _style_key(G):
+    return tuple((m.weight._version, m.weight.data_ptr(), m.bias._version, m.bias.data_ptr(), m.weight.device)
+                 for m, _, _ in _style_layers(G))
+
+class StyleAffine(object):
+    """
+    The modulation affines (EqualLinear) of every style layer packed into one table.
+    Consecutive layers fed by the same w+ entry (e.g. b8/torgb and b16/conv1) share one
+    (style_dim, sum of their dims) block, so W+ -> S is one matmul per w+ entry into the
+    concatenated style space instead of one F.linear (and one scaled weight temporary) per layer.
+    Follows the layer / w+ index mapping of encoder.
+    """
+    def __init__(self, G):
+        layers = _style_layers(G)
+        self.names = [name for _, _, name in layers]
+        self.dims = [m.weight.shape[0] for m, _, _ in layers]
+        # runs of consecutive layers reading the same w+ index
+        self.w_index, weights, biases = [], [], []
+        for m, i, _ in layers:
+            if not self.w_index or self.w_index[-1] != i:
+                self.w_index.append(i); weights.append([]); biases.append([])
+            weights[-1].append(m.weight * m.scale)
+            biases[-1].append(m.bias * m.lr_mul)
+        self.weights = [torch.cat(w).t().contiguous() for w in weights] # (style_dim, dims)
+        self.biases = [torch.cat(b) for b in biases]
+
+    def __call__(self, latent):
+        """
+        latent: W+ codes (N, n_latent, style_dim) -> concatenated style space (N, sum(dims))
+        """
+        return torch.cat([torch.addmm(b, latent[:, i].to(w.dtype), w) for i, w, b in zip(self.w_index, self.weights, self.biases)], dim=1)
+
+    def split(self, s):
+        """
+        Per layer views (N, dim) of a concatenated style space
+        """
+        return list(torch.split(s, self.dims, dim=1))
+
+def style_affine(G):
+    """
+    Packed StyleAffine of G, built once and kept on G until a modulation weight is modified
+    (load_state_dict, optimizer step, .to()). Built fresh, and differentiable, while
+    gradients are enabled for the generator weights
+    """
+    if torch.is_grad_enabled() and G.conv1.conv.modulation.weight.requires_grad:
+        return StyleAffine(G)
+    key = _style_key(G)
+    if getattr(G, '_style_affine_key', None) != key:
+        with torch.no_grad():
+            G._style_affine = StyleAffine(G)
+        G._style_affine_key = key
+    return G._style_affine
+
+def encoder(G, latent):
+    """
+    W+ codes (N, n_latent, style_dim) -> style space as a list of per layer (N, dim) views
+    of one packed affine output, their names and the noise constants
+    """
     noise_constants = [getattr(G.noises, 'noise_{}'.format(i)) for i in range(G.num_layers)]
-    style_space = []
-    style_names = []
-    # rgb_style_space = []
-    style_space.append(G.conv1.conv.modulation(latent[:, 0]))
-    res=4
-    style_names.append(f"b{res}/conv1")
-    style_space.append(G.to_rgbs[0].conv.modulation(latent[:, 0]))
-    style_names.append(f"b{res}/torgb")
-    i = 1; j=3
-    for conv1, conv2, noise1, noise2, to_rgb in zip(
-        G.convs[::2], G.convs[1::2], noise_constants[1::2], noise_constants[2::2], G.to_rgbs
-    ):
-        res=2**j
-        style_space.append(conv1.conv.modulation(latent[:, i]))
-        style_names.append(f"b{res}/conv1")
-        style_space.append(conv2.conv.modulation(latent[:, i+1]))
-        style_names.append(f"b{res}/conv2")
-        style_space.append(to_rgb.conv.modulation(latent[:, i + 2]))
-        style_names.append(f"b{res}/torgb")
-        i += 2; j += 1
-        
-    return style_space, style_names, noise_constants
+    affine = style_affine(G)
+    style_space = affine.split(affine(latent))
+    return style_space, list(affine.names), noise_constants
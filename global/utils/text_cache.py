@@ -0,0 +1,102 @@
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+import torch
+
+_CACHES = {}
+
+def template_hash(templates):
+    return hashlib.sha1("\n".join(templates).encode()).hexdigest()[:16]
+
+
+class TextEmbeddingCache(object):
+    """
+    Persistent cache of template-averaged, normalized CLIP text embeddings keyed by
+    (CLIP model name, text tower dtype, template set hash, text).
+    Rows are appended to a float32 memory-mapped file; index.json maps keys to rows.
+    Appends from concurrent processes are serialized with a lock file.
+    """
+    def __init__(self, root, dim=512):
+        self.root = root
+        self.dim = dim
+        self.data_path = os.path.join(root, 'embeddings.f32')
+        self.index_path = os.path.join(root, 'index.json')
+        self.lock_path = os.path.join(root, 'lock')
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        if self.index:
+            self.data = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(len(self.index), self.dim))
+        else:
+            self.data = np.zeros((0, self.dim), dtype=np.float32)
+
+    @staticmethod
+    def key(model_name, templates, text, dtype=torch.float32):
+        return hashlib.sha1(f"{model_name}\0{dtype}\0{template_hash(templates)}\0{text}".encode()).hexdigest()
+
+    def get(self, keys):
+        """
+        Returns {key: (dim, ) array} of the cached keys
+        """
+        if any(k not in self.index for k in keys):
+            self._load() # other processes may have added them
+        return {k: self.data[self.index[k]] for k in keys if k in self.index}
+
+    def put(self, keys, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(keys), self.dim)
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            new = {}
+            for k, e in zip(keys, embeddings):
+                if k not in self.index and k not in new:
+                    new[k] = e
+            if not new:
+                return
+            rows = len(self.index)
+            with open(self.data_path, 'ab') as f:
+                # drop rows of an interrupted append that never made it into the index
+                f.truncate(rows * self.dim * 4)
+                f.write(np.stack(list(new.values())).tobytes())
+            index = dict(self.index, **{k: rows + i for i, k in enumerate(new)})
+            # index last: rows it points to are complete
+            tmp = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, self.index_path)
+            self._load()
+
+    def lookup(self, texts, model_name, templates, encode, dtype=torch.float32):
+        """
+        dtype: weight dtype of the text tower, embeddings of fp16 / bf16 models are kept apart
+        encode: texts -> (len(texts), dim) tensor of template-averaged normalized embeddings,
+            called once with all the misses
+        Returns:
+            (len(texts), dim) float32 tensor
+        """
+        keys = [self.key(model_name, templates, text, dtype) for text in texts]
+        found = self.get(keys)
+        misses = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in found))
+        if misses:
+            embeddings = encode(misses).detach().float().cpu().numpy()
+            miss_keys = [self.key(model_name, templates, text, dtype) for text in misses]
+            self.put(miss_keys, embeddings)
+            found.update(zip(miss_keys, embeddings))
+        return torch.from_numpy(np.stack([np.asarray(found[k]) for k in keys]))
+
+
+def get_text_cache(root="./npy/text_cache", dim=512):
+    """
+    Process-wide text embedding cache per directory
+    """
+    key = os.path.abspath(root)
+    if key not in _CACHES:
+        _CACHES[key] = TextEmbeddingCache(root, dim)
+    return _CACHES[key]
@@ -1,4 +1,3 @@
-from sklearn.decomposition import PCA
 from torch.nn import functional as F
 from functools import partial
 import numpy as np
@@ -35,7 +34,15 @@ def projection(basis, target, multiple=False):
         X = X.squeeze(0)
         return l2norm((X.dot(B.T)/B.dot(B) * B).unsqueeze(0)).cuda()
 
+def psnr(img1, img2, data_range=2.0):
+    """
+    Peak signal-to-noise ratio between images in [-1, 1] (data_range 2)
+    """
+    mse = (img1.float() - img2.float()).pow(2).mean()
+    return (10 * torch.log10(data_range ** 2 / mse)).item()
+
 def project_away_pc(x, k=5):
+    from sklearn.decomposition import PCA
     pca = PCA(n_components=k)
     mean = x.mean()
     x_tmp = (x - mean)